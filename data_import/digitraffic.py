@@ -1,16 +1,22 @@
-import csv
+import io
+import os
 import re
+import json
+import functools
+from datetime import datetime, timedelta, timezone
 
-from datetime import datetime, timedelta
+import numpy as np
 import requests
 import pytz
 import pandas as pd
+from scipy.spatial import cKDTree
 
 
 API_BASE = 'http://tie.digitraffic.fi/api/v1/'
 RAW_BASE = 'https://aineistot.vayla.fi/lam/rawdata/'
 
 
+@functools.lru_cache(maxsize=None)
 def camel_str_to_snake(name):
     s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
@@ -26,9 +32,18 @@ def camel_dict_to_snake(d):
             camel_dict_to_snake(val)
 
 
-def get_tms_stations():
-    resp = requests.get(API_BASE + 'metadata/locations')
-    resp = requests.get(API_BASE + 'metadata/tms-stations')
+def fetch_tms_stations(etag=None, session=None):
+    """Fetch TMS station metadata.
+
+    If `etag` is given and the metadata has not changed since, returns
+    (None, etag). Otherwise returns (stations, new etag).
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    resp = (session or requests).get(API_BASE + 'metadata/tms-stations', headers=headers)
+    if resp.status_code == 304:
+        return None, etag
     resp.raise_for_status()
     data = resp.json()
     out = []
@@ -41,7 +56,135 @@ def get_tms_stations():
         props['coordinates'] = coords[0:2]  # drop the height coordinate
         out.append(props)
 
-    return out
+    return out, resp.headers.get('ETag')
+
+
+def get_tms_stations():
+    stations, _ = fetch_tms_stations()
+    return stations
+
+
+class StationRegistry:
+    """TMS station metadata with an on-disk cache and lookup indexes.
+
+    The stations are read from `cache_path`; the network is only used by
+    `refresh()`, which revalidates the cache with the ETag of the last
+    response once it is older than `ttl`. Stations are indexed by name, id
+    and municipality, and a KD-tree over their coordinates serves nearest
+    station and bounding box queries.
+    """
+
+    def __init__(self, cache_path, ttl=timedelta(days=7)):
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.fetched_at = None
+        self.etag = None
+        self.stations = []
+        self._index()
+
+    def _index(self):
+        self.by_name = {s['name']: s for s in self.stations}
+        self.by_id = {s['id']: s for s in self.stations}
+        self.by_municipality = {}
+        for s in self.stations:
+            if s.get('municipality_code'):
+                self.by_municipality.setdefault(int(s['municipality_code']), []).append(s)
+
+        self._tree = None
+        if self.stations:
+            coords = np.array([s['coordinates'] for s in self.stations], dtype=float)
+            self._lon, self._lat = coords[:, 0], coords[:, 1]
+            self._tree = cKDTree(self._project(self._lon, self._lat))
+
+    @staticmethod
+    def _project(lon, lat):
+        # Equirectangular projection in km; accurate enough for ranking
+        # distances within Finland
+        lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+        x = np.radians(lon) * np.cos(np.radians(lat)) * 6371
+        y = np.radians(lat) * 6371
+        return np.column_stack([x.ravel(), y.ravel()])
+
+    def load(self):
+        """Load stations from the disk cache. Returns False if there is none."""
+        if not os.path.exists(self.cache_path):
+            return False
+        with open(self.cache_path, 'r') as f:
+            data = json.load(f)
+        self.fetched_at = datetime.fromisoformat(data['fetched_at'])
+        self.etag = data.get('etag')
+        self.stations = data['stations']
+        self._index()
+        return True
+
+    def _save(self):
+        data = dict(fetched_at=self.fetched_at.isoformat(), etag=self.etag, stations=self.stations)
+        dir_name = os.path.dirname(self.cache_path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        tmp_path = '%s.tmp-%d' % (self.cache_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, self.cache_path)
+
+    def is_stale(self):
+        if self.fetched_at is None:
+            return True
+        return datetime.now(timezone.utc) - self.fetched_at > self.ttl
+
+    def refresh(self, force=False, session=None):
+        if not force and not self.is_stale():
+            return
+        stations, etag = fetch_tms_stations(etag=None if force else self.etag, session=session)
+        if stations is not None:
+            self.stations = stations
+            self._index()
+        self.etag = etag
+        self.fetched_at = datetime.now(timezone.utc)
+        self._save()
+
+    def get_by_name(self, name):
+        return self.by_name.get(name)
+
+    def get_by_id(self, station_id):
+        return self.by_id.get(station_id)
+
+    def in_municipality(self, municipality_code):
+        return self.by_municipality.get(int(municipality_code), [])
+
+    def nearest(self, lon, lat, count=1):
+        """Return the `count` stations closest to a point"""
+        if self._tree is None:
+            return []
+        count = min(count, len(self.stations))
+        _, idx = self._tree.query(self._project(lon, lat)[0], k=count)
+        return [self.stations[i] for i in np.atleast_1d(idx)]
+
+    def in_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Return the stations inside a bounding box.
+
+        The KD-tree is queried for the circle around the box, and only
+        those candidates are checked against the box itself.
+        """
+        if self._tree is None:
+            return []
+        # Meridians are not straight lines in the projection, so the circle
+        # has to cover points along the box edges, not just its corners
+        edge = np.linspace(0, 1, 9)
+        lon = np.concatenate([
+            min_lon + edge * (max_lon - min_lon), np.full(9, max_lon),
+            max_lon - edge * (max_lon - min_lon), np.full(9, min_lon),
+        ])
+        lat = np.concatenate([
+            np.full(9, min_lat), min_lat + edge * (max_lat - min_lat),
+            np.full(9, max_lat), max_lat - edge * (max_lat - min_lat),
+        ])
+        center = self._project((min_lon + max_lon) / 2, (min_lat + max_lat) / 2)[0]
+        radius = np.sqrt(((self._project(lon, lat) - center) ** 2).sum(axis=1)).max()
+        idx = np.array(self._tree.query_ball_point(center, radius * 1.01 + 1e-6), dtype=int)
+        lon, lat = self._lon[idx], self._lat[idx]
+        mask = (lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)
+        return [self.stations[i] for i in np.sort(idx[mask])]
 
 
 RAW_DATA_FIELDS = [
@@ -78,69 +221,129 @@ VEHICLE_CLASSES = {
 LOCAL_TZ = pytz.timezone('Europe/Helsinki')
 
 
-def fetch_tms_station_raw_data(ely_id, lam_id, measurement_date):
+def fetch_tms_station_raw_data(ely_id, lam_id, measurement_date, session=None):
     day_of_year = measurement_date.timetuple().tm_yday
     year = measurement_date.year
     url = RAW_BASE + '%d/%s/lamraw_%s_%d_%d.csv' % (
         year, ely_id, lam_id, year % 1000, day_of_year
     )
-    resp = requests.get(url)
+    resp = (session or requests).get(url)
     resp.raise_for_status()
     return resp.content.decode('utf8')
 
 
+RAW_DATA_DTYPES = {
+    'station_id': str,
+    'length': 'float64',
+}
+
+
 def parse_tms_station_raw_data(lam_id, measurement_date, content):
-    lines = content.split('\n')
-    reader = csv.DictReader(lines, fieldnames=RAW_DATA_FIELDS, delimiter=';')
-    faulty = 0
-    out = []
-    lam_id = str(lam_id)
-    for row in reader:
-        # Skip faulty readings here
-        if row.pop('faulty') == '1':
-            faulty += 1
-            continue
-
-        for key, value in row.items():
-            if key == 'station_id':
-                assert value == lam_id
-            elif key in ('length',):
-                value = float(value)
-            else:
-                value = int(value)
-            if key == 'vehicle_class':
-                value = VEHICLE_CLASSES[value]
-            row[key] = value
-
-        year = row.pop('year')
-        # Y2k ♥ -- this will break in 2070!!
-        if year > 70:
-            year += 1900
-        else:
-            year += 2000
-
-        # Convert day of year to date
-        dt = datetime(year, 1, 1) + timedelta(days=row.pop('day_of_year') - 1)
-        dt = dt.replace(
-            hour=row.pop('hour'), minute=row.pop('minute'), second=row.pop('second'),
-            microsecond=row.pop('second_10ms') * 10 * 1000
-        )
-
-        assert dt.date() == measurement_date  # sanity check
-        row['time'] = LOCAL_TZ.localize(dt)
-        # Remove the "technical" fields
-        del row['time_interval']
-        del row['queue_start']
-        del row['total_time']
-        out.append(row)
+    """Parse the contents of a LAM raw data file into a DataFrame.
+
+    The file is parsed with the C CSV parser into typed columns and all the
+    conversions are done as array operations, so the cost per vehicle
+    passage is small even for the busiest stations.
+    """
+    dtypes = {f: RAW_DATA_DTYPES.get(f, 'int64') for f in RAW_DATA_FIELDS}
+    if content.strip():
+        df = pd.read_csv(io.StringIO(content), sep=';', header=None, names=RAW_DATA_FIELDS, dtype=dtypes)
+    else:
+        df = pd.DataFrame({f: pd.Series(dtype=dtype) for f, dtype in dtypes.items()})
+    assert (df['station_id'] == str(lam_id)).all()
+
+    # Skip faulty readings here
+    faulty_mask = (df['faulty'] == 1).to_numpy()
+    faulty = int(faulty_mask.sum())
+    df = df[~faulty_mask]
+
+    # Y2k ♥ -- this will break in 2070!!
+    year = df['year'].to_numpy()
+    year = np.where(year > 70, year + 1900, year + 2000)
+
+    # Build the timestamps from their components with datetime64 arithmetic
+    ts = (year - 1970).astype('datetime64[Y]').astype('datetime64[ms]')
+    ts += (df['day_of_year'].to_numpy() - 1).astype('timedelta64[D]')
+    ts += df['hour'].to_numpy().astype('timedelta64[h]')
+    ts += df['minute'].to_numpy().astype('timedelta64[m]')
+    ts += df['second'].to_numpy().astype('timedelta64[s]')
+    ts += (df['second_10ms'].to_numpy() * 10).astype('timedelta64[ms]')
+
+    # Sanity check
+    measurement_day = np.datetime64(measurement_date, 'D')
+    assert (ts.astype('datetime64[D]') == measurement_day).all()
+
+    vehicle_class = df['vehicle_class'].map(VEHICLE_CLASSES)
+    if vehicle_class.isna().any():
+        raise KeyError(df['vehicle_class'][vehicle_class.isna()].iloc[0])
 
     # If there are more than 5% faulty measurements, bail out
-    if faulty > int(0.05 * len(out)):
-        raise Exception("Too many faulty measurements (%d faulty, %d OK)" % (faulty, len(out)))
+    if faulty > int(0.05 * len(df)):
+        raise Exception("Too many faulty measurements (%d faulty, %d OK)" % (faulty, len(df)))
+
+    # Resolve ambiguous and non-existent local times like pytz localize()
+    # does by default (is_dst=False).
+    index = pd.DatetimeIndex(ts.astype('datetime64[ns]'), name='time').tz_localize(
+        LOCAL_TZ, ambiguous=np.zeros(len(ts), dtype=bool), nonexistent=pd.Timedelta(hours=1)
+    )
+    out = pd.DataFrame({
+        'station_id': df['station_id'].to_numpy(),
+        'direction': df['direction'].to_numpy(),
+        'lane': df['lane'].to_numpy(),
+        'vehicle_class': vehicle_class.to_numpy(),
+        'length': df['length'].to_numpy(),
+        'speed': df['speed'].to_numpy(),
+    }, index=index)
+    return out
+
+
+def count_vehicles_per_minute(df, measurement_date, direction_names):
+    """Count vehicle passages per minute, direction and vehicle class.
+
+    `df` is a frame returned by `parse_tms_station_raw_data()` and
+    `direction_names` the location names for directions 1 and 2. The
+    passages are binned into a dense (direction, minute of day, vehicle
+    class) array with one `np.bincount`, so minutes without passages get
+    zero counts. For each direction, the minutes between the first and last
+    passage are returned, with a `station_direction` column and one count
+    column per vehicle class.
+    """
+    class_names = list(VEHICLE_CLASSES.values())
+    nr_classes = len(class_names)
+    nr_directions = len(direction_names)
+
+    day_start = pd.Timestamp(measurement_date).tz_localize(LOCAL_TZ)
+    day_end = (pd.Timestamp(measurement_date) + pd.Timedelta(days=1)).tz_localize(LOCAL_TZ)
+    # DST transition days have 23 or 25 hours
+    nr_minutes = int((day_end - day_start) / pd.Timedelta(minutes=1))
 
-    COLUMN_ORDER = ['time', 'station_id', 'direction', 'lane', 'vehicle_class', 'length', 'speed']
-    df = pd.DataFrame.from_records(out, index='time', columns=COLUMN_ORDER)
-    return df
+    minute = (df.index.asi8 - day_start.value) // (60 * 1000 * 1000 * 1000)
+    direction = df['direction'].to_numpy() - 1
+    vehicle_class = pd.Categorical(df['vehicle_class'], categories=class_names).codes
+    assert ((minute >= 0) & (minute < nr_minutes)).all()
+    assert ((direction >= 0) & (direction < nr_directions)).all()
+    assert (vehicle_class >= 0).all()
+
+    bins = (direction * nr_minutes + minute) * nr_classes + vehicle_class
+    counts = np.bincount(bins, minlength=nr_directions * nr_minutes * nr_classes)
+    counts = counts.reshape(nr_directions, nr_minutes, nr_classes)
+
+    minute_times = pd.DatetimeIndex(
+        day_start.value + np.arange(nr_minutes, dtype='int64') * 60 * 1000 * 1000 * 1000, tz='UTC',
+    ).tz_convert(LOCAL_TZ)
+
+    dfs = []
+    for dir_idx, dir_name in enumerate(direction_names):
+        active = np.flatnonzero(counts[dir_idx].any(axis=1))
+        assert len(active), 'No passages in direction %d' % (dir_idx + 1)
+        minutes = slice(active[0], active[-1] + 1)
+        dir_df = pd.DataFrame(counts[dir_idx, minutes], columns=class_names, index=minute_times[minutes])
+        dir_df.insert(0, 'station_direction', dir_name)
+        dfs.append(dir_df)
+
+    out = pd.concat(dfs)
+    out.index.name = 'time'
+    return out
 
 
 def get_tms_station_raw_data(ely_id, lam_id, measurement_date):
@@ -1,5 +1,5 @@
 import io
-from datetime import datetime, timezone, date
+from datetime import datetime, timezone, date, timedelta
 import logging
 
 import requests
@@ -19,7 +19,7 @@ fingrid_api_key = None
 LOCAL_TZ = pytz.timezone('Europe/Helsinki')
 
 
-def fingrid_api_get(variable_id, quantity, unit, time_interval, start_time, end_time):
+def fingrid_api_get(variable_id, quantity, unit, time_interval, start_time, end_time, session=None):
     assert fingrid_api_key is not None
 
     url = 'https://api.fingrid.fi/v1/variable/%s/events/csv' % variable_id
@@ -38,7 +38,7 @@ def fingrid_api_get(variable_id, quantity, unit, time_interval, start_time, end_
     headers = {
         'x-api-key': fingrid_api_key,
     }
-    resp = requests.get(url, params=params, headers=headers)
+    resp = (session or requests).get(url, params=params, headers=headers)
     resp.raise_for_status()
     data = io.StringIO(resp.content.decode('utf-8'))
     df = pd.read_csv(data, header=0, parse_dates=['start_time', 'end_time'])
@@ -79,6 +79,11 @@ def set_api_key(api_key):
 HOURLY = 3600
 THREE_MIN = 3 * 60
 
+# Request quota of the Fingrid open data API
+API_REQUESTS_PER_MINUTE = 10
+# Maximum number of rows to ask for in one API request
+API_MAX_ROWS = 20000
+
 
 MEASUREMENTS = {
     "electricity_production_hourly": {
@@ -241,10 +246,11 @@ def _check_variable_uniqueness():
         raise Exception("Duplicate variable ids: %s" % sorted(variables))
 
 
-def get_measurements(measurement_name, start_time, end_time, include_units=False):
+def get_measurements(measurement_name, start_time, end_time, include_units=False, session=None):
     m = MEASUREMENTS[measurement_name]
     df = fingrid_api_get(
-        m['variable_id'], m['quantity'], m['unit'], int(m['interval'] / 60), start_time, end_time
+        m['variable_id'], m['quantity'], m['unit'], int(m['interval'] / 60), start_time, end_time,
+        session=session
     )
     # Filter buggy data if we know already that the values can't be more than 'max_value'
     max_value = m.get('max_value')
@@ -266,11 +272,43 @@ def get_measurement_meta_data(measurement_name):
     return MEASUREMENTS[measurement_name]
 
 
+def get_measurement_time_range(measurement_name, end_time=None):
+    """Return the (start_time, end_time) range with data for a measurement"""
+    m = MEASUREMENTS[measurement_name]
+    start_time = LOCAL_TZ.localize(datetime.combine(m['start_date'], datetime.min.time()))
+    now = datetime.now(LOCAL_TZ)
+    if end_time is None or end_time > now:
+        end_time = now
+    if m.get('end_date'):
+        end_time = min(end_time, LOCAL_TZ.localize(datetime.combine(m['end_date'], datetime.min.time())))
+    return start_time, end_time
+
+
+def split_time_range(measurement_name, start_time, end_time, max_rows=API_MAX_ROWS):
+    """Split [start_time, end_time) into windows that fit in one API request.
+
+    Windows are aligned to `start_time`, so splitting the same range again
+    later yields the same window boundaries.
+    """
+    m = MEASUREMENTS[measurement_name]
+    step = timedelta(seconds=m['interval'] * max_rows)
+    windows = []
+    window_start = start_time
+    while window_start < end_time:
+        window_end = min(window_start + step, end_time)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+
 _check_variable_uniqueness()
 
 
 if __name__ == '__main__':
-    from utils.data_import import find_data_start
+    from concurrent.futures import ThreadPoolExecutor
+    from functools import partial
+    from utils.data_import import find_data_start_parallel
+    from utils.rate_limit import TokenBucket
     import settings
 
     set_api_key(settings.FINGRID_API_KEY)
@@ -279,17 +317,21 @@ if __name__ == '__main__':
     exit()
 
 
-    for name, m in [x for x in MEASUREMENTS.items() if not x[1].get('start_date')]:
-        def check_date(check_date):
-            start_time = datetime.combine(check_date, datetime.min.time())
-            end_time = datetime.combine(check_date, datetime.max.time())
-            try:
-                get_measurements(name, start_time, end_time)
-            except NoRowsReturned:
-                return False
+    rate_limiter = TokenBucket.per_minute(API_REQUESTS_PER_MINUTE)
+
+    def check_date(name, check_date):
+        start_time = datetime.combine(check_date, datetime.min.time())
+        end_time = datetime.combine(check_date, datetime.max.time())
+        rate_limiter.acquire()
+        try:
+            get_measurements(name, start_time, end_time)
+        except NoRowsReturned:
+            return False
 
-            return True
+        return True
 
-        ds = find_data_start(check_date)
-        print(name)
-        print('        "start_date": date(%d, %d, %d),' % (ds.year, ds.month, ds.day))
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for name, m in [x for x in MEASUREMENTS.items() if not x[1].get('start_date')]:
+            ds = find_data_start_parallel(partial(check_date, name), probes=4, executor=executor)
+            print(name)
+            print('        "start_date": date(%d, %d, %d),' % (ds.year, ds.month, ds.day))
@@ -1,24 +1,65 @@
-import math
 import re
 import io
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 import requests
 from datetime import datetime, date, timedelta
 import dateutil.parser
 import pytz
-from owslib.wfs import WebFeatureService
 from lxml import etree
 
+from utils.checkpoint import Checkpoint
+from utils.http import get_http_session
+from utils.perf import ThroughputMeter
+from utils.rate_limit import TokenBucket
 import settings
 
 
 LOCAL_TZ = pytz.timezone('Europe/Helsinki')
+CACHE_DIR = os.path.join(settings.DATA_DIR, 'fmi/cache')
+# The observable property descriptions change very rarely
+META_CACHE_TTL = timedelta(days=7)
+# A cached forecast is served for this long before checking for a newer model run
+FORECAST_CACHE_TTL = timedelta(minutes=30)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the HTTP session shared by all FMI API calls"""
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = get_http_session()
+        return _session
+
+
+def _is_fresh(path, ttl):
+    if not os.path.exists(path):
+        return False
+    return time.time() - os.path.getmtime(path) < ttl.total_seconds()
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
 URL_FORMAT = 'https://cdn.fmi.fi/weather-observations/products/heating-degree-days/lammitystarveluvut-{year}.utf8.csv'
 
 
-def _get_heating_degree_days_excel():
+def _get_heating_degree_days_excel(session=None):
     URL = 'https://cdn.fmi.fi/legacy-fmi-fi-content/documents/climate/hdd_1995-2007.xlsx'
     COLS = ('Kunta', 'I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X', 'XI', 'XII', 'Yhteensä')
     KUNTA_MAP = {
@@ -28,7 +69,7 @@ def _get_heating_degree_days_excel():
         "tampere-pirkkalan": "Tampere",
         "inari/ivalo": "Ivalo",
     }
-    resp = requests.get(URL)
+    resp = (session or requests).get(URL)
     resp.raise_for_status()
     f = io.BytesIO(resp.content)
     sheets = pd.read_excel(f, sheet_name=None, header=1, names=COLS)
@@ -46,33 +87,121 @@ def _get_heating_degree_days_excel():
     return all_dfs
 
 
+def _get_heating_degree_days_csv(year, session=None):
+    url = URL_FORMAT.format(year=year)
+    resp = (session or requests).get(url)
+    resp.raise_for_status()
+    f = io.BytesIO(resp.content)
+    df = pd.read_csv(f)
+    df = df.rename(columns={df.columns[0]: 'Kunta'})
+    df['Yhteensä'] = df['Vuosi']
+    df['Vuosi'] = year
+    df = df.set_index('Vuosi').reset_index()
+    return df
+
+
 def get_heating_degree_days():
-    dfs = _get_heating_degree_days_excel()
-    for year in range(2008, 2018):
-        url = URL_FORMAT.format(year=year)
-        resp = requests.get(url)
-        resp.raise_for_status()
-        f = io.BytesIO(resp.content)
-        df = pd.read_csv(f)
-        df = df.rename(columns={df.columns[0]: 'Kunta'})
-        df['Yhteensä'] = df['Vuosi']
-        df['Vuosi'] = year
-        df = df.set_index('Vuosi').reset_index()
-        dfs.append(df)
+    session = get_session()
+    dfs = _get_heating_degree_days_excel(session)
+    years = discover_heating_degree_day_years(session)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        dfs += list(executor.map(lambda year: _get_heating_degree_days_csv(year, session), years))
 
     df = pd.concat(dfs, ignore_index=True, sort=False)
     return df
 
 
-def get_meta(language, property_type):
-    assert property_type in ('forecast', 'observation')
-    assert language in ('fin', 'eng')
+HDD_DATASET_PATH = os.path.join(settings.DATA_DIR, 'fmi/heating_degree_days.parquet')
+HDD_EXCEL_YEARS = range(1995, 2008)
+HDD_FIRST_CSV_YEAR = 2008
+
+
+def _heating_degree_days_to_long(df):
+    """Convert one year in the wide format into (municipality, year, month) rows"""
+    month_cols = [c for c in df.columns if c not in ('Vuosi', 'Kunta', 'Yhteensä')]
+    assert len(month_cols) == 12, 'Unexpected columns: %s' % ', '.join(df.columns)
+    out = df.melt(id_vars=['Kunta', 'Vuosi'], value_vars=month_cols, var_name='month', value_name='heating_degree_days')
+    out['month'] = out['month'].map({col: idx + 1 for idx, col in enumerate(month_cols)})
+    out['heating_degree_days'] = pd.to_numeric(out['heating_degree_days'], errors='coerce')
+    out = out.rename(columns={'Kunta': 'municipality', 'Vuosi': 'year'})
+    return out[['municipality', 'year', 'month', 'heating_degree_days']]
+
+
+def discover_heating_degree_day_years(session=None, workers=8):
+    """Return the years that have a heating degree day CSV file published"""
+    session = session or get_session()
+
+    def is_available(year):
+        resp = session.head(URL_FORMAT.format(year=year), allow_redirects=True)
+        return resp.status_code == 200
+
+    years = list(range(HDD_FIRST_CSV_YEAR, date.today().year + 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        available = list(executor.map(is_available, years))
+    return [year for year, ok in zip(years, available) if ok]
+
+
+def update_heating_degree_day_dataset(workers=8):
+    """Fetch the missing years of the heating degree day dataset.
+
+    The dataset is stored in long format with one row per municipality,
+    year and month. Only years that are not stored yet are fetched, in
+    parallel; the last two years are always fetched again, because the
+    files of the ongoing year are updated monthly.
+    """
+    session = get_session()
+    if os.path.exists(HDD_DATASET_PATH):
+        existing = pd.read_parquet(HDD_DATASET_PATH, engine='fastparquet')
+    else:
+        existing = None
+    have_years = set(existing['year'].unique()) if existing is not None else set()
+
+    dfs = []
+    if not have_years & set(HDD_EXCEL_YEARS):
+        dfs += [_heating_degree_days_to_long(df) for df in _get_heating_degree_days_excel(session)]
+
+    current_year = date.today().year
+    years = [
+        year for year in discover_heating_degree_day_years(session, workers=workers)
+        if year not in have_years or year >= current_year - 1
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for df in executor.map(lambda year: _get_heating_degree_days_csv(year, session), years):
+            dfs.append(_heating_degree_days_to_long(df))
+
+    if not dfs:
+        return existing
+
+    df = pd.concat(dfs, ignore_index=True)
+    if existing is not None:
+        existing = existing[~existing['year'].isin(df['year'].unique())]
+        df = pd.concat([existing, df], ignore_index=True)
+    df = df.sort_values(['municipality', 'year', 'month'], ignore_index=True)
+
+    os.makedirs(os.path.dirname(HDD_DATASET_PATH), exist_ok=True)
+    df.to_parquet(HDD_DATASET_PATH + '.tmp', engine='fastparquet', compression='zstd', index=False)
+    os.replace(HDD_DATASET_PATH + '.tmp', HDD_DATASET_PATH)
+    return df
+
+
+def load_heating_degree_days(municipality=None):
+    """Return the stored heating degree day dataset, building it if needed"""
+    if os.path.exists(HDD_DATASET_PATH):
+        df = pd.read_parquet(HDD_DATASET_PATH, engine='fastparquet')
+    else:
+        df = update_heating_degree_day_dataset()
+    if municipality is not None:
+        df = df[df['municipality'] == municipality].reset_index(drop=True)
+    return df
+
+
+def _fetch_meta(language, property_type):
     url = 'https://opendata.fmi.fi/meta'
     params = {
         'observableProperty': property_type,
         'language': language
     }
-    resp = requests.get(url, params=params)
+    resp = get_session().get(url, params=params)
     resp.raise_for_status()
     root = etree.fromstring(resp.content)
     properties = root.findall('.//{*}ObservableProperty')
@@ -90,8 +219,8 @@ def get_meta(language, property_type):
             d['unit'] = None
         sm = prop.find('{*}StatisticalMeasure')
         if sm is not None:
-            d['stat_function'] = sm.find('statisticalFunction')
-            d['aggregation_time_period'] = sm.find('aggregationTimePeriod')
+            d['stat_function'] = sm.findtext('{*}statisticalFunction')
+            d['aggregation_time_period'] = sm.findtext('{*}aggregationTimePeriod')
 
         assert d['id'] not in out
         out[d['id']] = d
@@ -99,9 +228,57 @@ def get_meta(language, property_type):
     return out
 
 
-def get_forecast(place=None, latlon=None, timestep=60, start_time=None, end_time=None):
-    url = 'https://opendata.fmi.fi/wfs'
-    wfs = WebFeatureService(url=url, version='2.0.0')
+def get_meta(language, property_type, ttl=META_CACHE_TTL):
+    """Return the observable properties, cached on disk for `ttl`"""
+    assert property_type in ('forecast', 'observation')
+    assert language in ('fin', 'eng')
+
+    path = os.path.join(CACHE_DIR, 'meta-%s-%s.json' % (property_type, language))
+    if _is_fresh(path, ttl):
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    out = _fetch_meta(language, property_type)
+    _write_atomic(path, json.dumps(out, ensure_ascii=False))
+    return out
+
+
+def _get_forecast_cache_dir(place, latlon, timestep, start_time):
+    if latlon:
+        key = 'latlon-%s_%s' % (latlon[0], latlon[1])
+    else:
+        key = 'place-%s' % re.sub(r'[^\w.-]', '_', place or '')
+    key += '-%s' % timestep
+    if start_time:
+        key += '-%s' % start_time.isoformat().split('.')[0].replace(':', '')
+    return os.path.join(CACHE_DIR, 'forecasts', key)
+
+
+def _get_forecast_cache_path(cache_dir, result_time):
+    return os.path.join(cache_dir, '%s.parquet' % result_time.astimezone(pytz.utc).strftime('%Y%m%dT%H%M%SZ'))
+
+
+def _fetch_forecast(params):
+    query_id = 'fmi::forecast::harmonie::surface::point::multipointcoverage'
+    with open_wfs_query(query_id, params) as resp:
+        result_time, df = parse_multipoint_coverage(resp.raw)
+
+    if 'PrecipitationAmount' in df.columns:
+        # The forecast has the cumulative precipitation; convert it to per timestep
+        df['PrecipitationAmount'] = np.diff(df['PrecipitationAmount'].to_numpy(), prepend=0)
+
+    return result_time, df.drop(columns=['station', 'lat', 'lon'])
+
+
+def get_forecast(place=None, latlon=None, timestep=60, start_time=None, end_time=None, origin_time=None,
+                 ttl=FORECAST_CACHE_TTL):
+    """Return the point forecast for a place or coordinates.
+
+    Forecasts are cached on disk by location, timestep and the model run
+    (`result_time`). The latest cached run is served for `ttl` after it
+    was fetched; a specific model run can be requested with `origin_time`
+    and is served from the cache whenever it is there.
+    """
     params = {
         'timestep': timestep
     }
@@ -112,42 +289,151 @@ def get_forecast(place=None, latlon=None, timestep=60, start_time=None, end_time
 
     if start_time:
         params['starttime'] = start_time.isoformat().split('.')[0] + 'Z'
-    query_id = 'fmi::forecast::harmonie::surface::point::multipointcoverage'
+    if origin_time:
+        params['origintime'] = convert_time(origin_time)
+
+    cache_dir = _get_forecast_cache_dir(place, latlon, timestep, start_time)
+    path = None
+    if origin_time:
+        path = _get_forecast_cache_path(cache_dir, origin_time)
+        if not os.path.exists(path):
+            path = None
+    elif os.path.exists(cache_dir):
+        snapshots = sorted(x for x in os.listdir(cache_dir) if x.endswith('.parquet'))
+        if snapshots and _is_fresh(os.path.join(cache_dir, snapshots[-1]), ttl):
+            path = os.path.join(cache_dir, snapshots[-1])
+
+    if path is not None:
+        df = pd.read_parquet(path, engine='fastparquet')
+        result_time = datetime.strptime(os.path.basename(path), '%Y%m%dT%H%M%SZ.parquet')
+        result_time = pytz.utc.localize(result_time).astimezone(LOCAL_TZ)
+    else:
+        result_time, df = _fetch_forecast(params)
+        path = _get_forecast_cache_path(cache_dir, result_time)
+        os.makedirs(cache_dir, exist_ok=True)
+        df.to_parquet(path + '.tmp', engine='fastparquet', index=False)
+        os.replace(path + '.tmp', path)
 
-    resp = wfs.getfeature(storedQueryID=query_id, storedQueryParams=params)
-    root = etree.fromstring(bytes(resp.read(), encoding='utf8'))
-    print(str(etree.tostring(root), encoding='utf8'))
-
-    result_time = root.find('.//{*}resultTime//{*}timePosition').text
-    result_time = dateutil.parser.parse(result_time).astimezone(LOCAL_TZ)
-
-    positions = root.find('.//{*}positions').text
-    observations = root.find('.//{*}DataBlock/{*}doubleOrNilReasonTupleList').text
-    fields = root.findall('.//{*}DataRecord/{*}field')
-    field_names = [x.attrib['name'] for x in fields]
-
-    positions = [re.findall(r'\S+', x.strip()) for x in positions.splitlines() if x.strip()]
-    observations = [re.findall(r'\S+', x.strip()) for x in observations.splitlines() if x.strip()]
-
-    data = []
-    last_precipitation = None
-    for pos, obs in zip(positions, observations):
-        d = {field_name: float(sample) for field_name, sample in zip(field_names, obs)}
-        ts = datetime.fromtimestamp(int(pos[2]))
-        ts.replace(tzinfo=pytz.UTC)
-        d['time'] = LOCAL_TZ.localize(ts)
-        if 'PrecipitationAmount' in d:
-            if last_precipitation:
-                val = d['PrecipitationAmount']
-                d['PrecipitationAmount'] -= last_precipitation
-                last_precipitation = val
-            else:
-                last_precipitation = d['PrecipitationAmount']
-        data.append(d)
+    data = df.to_dict('records')
 
     return dict(observations=data, meta=dict(result_time=result_time))
 
 
+def _decode_tuple_list(text):
+    """Parse a whitespace separated block of numbers into a flat array"""
+    if not text or not text.strip():
+        return np.empty(0)
+    return np.fromstring(text, dtype=float, sep=' ')
+
+
+def decode_multipoint_coverage(positions, values, field_names, points=None):
+    """Decode the data blocks of a multipointcoverage response.
+
+    `positions` and `values` are the numbers of the `positions` and
+    `doubleOrNilReasonTupleList` blocks as flat arrays, and `points` maps
+    (lat, lon) tuples to station names. Returns a DataFrame with one row
+    per observation, with `station` (if `points` was given), `lat`, `lon`
+    and `time` columns followed by the fields.
+    """
+    pos = positions.reshape(-1, 3)
+    vals = values.reshape(len(pos), len(field_names))
+    assert len(pos) == len(vals)
+
+    df = pd.DataFrame(vals, columns=field_names)
+    times = pd.to_datetime(pos[:, 2].astype('int64'), unit='s', utc=True).tz_convert(LOCAL_TZ)
+    df.insert(0, 'time', times)
+    df.insert(0, 'lon', pos[:, 1])
+    df.insert(0, 'lat', pos[:, 0])
+    if points is not None and not points:
+        df.insert(0, 'station', pd.Series([None] * len(df), dtype=object))
+    elif points is not None:
+        stations = pd.Series(list(points.values()), index=pd.MultiIndex.from_tuples(list(points.keys())), dtype=object)
+        coords = pd.MultiIndex.from_arrays([pos[:, 0], pos[:, 1]])
+        df.insert(0, 'station', stations.reindex(coords).to_numpy())
+    return df
+
+
+COVERAGE_TAGS = (
+    '{*}resultTime', '{*}Point', '{*}positions', '{*}doubleOrNilReasonTupleList', '{*}DataRecord',
+)
+
+
+def parse_multipoint_coverage(source):
+    """Parse a multipointcoverage response incrementally from a file object.
+
+    Elements are cleared as soon as they have been handled and the data
+    blocks are converted into arrays right away, so the XML tree is never
+    held in memory. Returns the result time and the decoded DataFrame.
+    """
+    result_time = None
+    points = {}
+    field_names = None
+    positions = []
+    values = []
+
+    # The data blocks of long queries exceed libxml2's default text node limit
+    for _, el in etree.iterparse(source, events=('end',), tag=COVERAGE_TAGS, huge_tree=True):
+        tag = etree.QName(el).localname
+        if tag == 'resultTime':
+            if result_time is None:
+                result_time = el.find('.//{*}timePosition').text
+        elif tag == 'Point':
+            lat, lon = [float(x) for x in el.find('{*}pos').text.split()]
+            points[(lat, lon)] = el.find('{*}name').text
+        elif tag == 'positions':
+            positions.append(_decode_tuple_list(el.text))
+        elif tag == 'doubleOrNilReasonTupleList':
+            values.append(_decode_tuple_list(el.text))
+        elif tag == 'DataRecord':
+            field_names = [x.attrib['name'] for x in el.findall('{*}field')]
+
+        el.clear(keep_tail=True)
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+
+    if result_time is not None:
+        result_time = dateutil.parser.parse(result_time).astimezone(LOCAL_TZ)
+    if field_names is None:
+        # No observations matched the query
+        field_names = []
+
+    df = decode_multipoint_coverage(
+        np.concatenate(positions) if positions else np.empty(0),
+        np.concatenate(values) if values else np.empty(0),
+        field_names, points,
+    )
+    return result_time, df
+
+
+WFS_URL = 'https://opendata.fmi.fi/wfs'
+
+
+def open_wfs_query(query_id, params):
+    """Run a WFS stored query and return the streaming response"""
+    req_params = dict(service='WFS', version='2.0.0', request='getFeature', storedquery_id=query_id)
+    req_params.update(params)
+    resp = get_session().get(WFS_URL, params=req_params, stream=True)
+    resp.raise_for_status()
+    # Let urllib3 undo any gzip/deflate transfer encoding
+    resp.raw.decode_content = True
+    return resp
+
+
+def _coverage_to_observations(df):
+    """Convert a decoded coverage frame into the list of dicts format"""
+    locations = {}
+    for station, lat, lon in df[['station', 'lat', 'lon']].drop_duplicates().itertuples(index=False):
+        locations[(lat, lon)] = dict(name=station, coords=[lat, lon])
+
+    values = df.drop(columns=['station', 'lat', 'lon', 'time']).astype(object)
+    values = values.where(values.notna(), None)
+    data = values.to_dict('records')
+    for d, ts, lat, lon in zip(data, df['time'], df['lat'], df['lon']):
+        d['time'] = ts
+        d['location'] = locations[(lat, lon)]
+    return data
+
+
 def convert_time(dt):
     if not isinstance(dt, datetime):
         dt = datetime.combine(dt, datetime.min.time())
@@ -156,8 +442,6 @@ def convert_time(dt):
 
 
 def get_fmi_multipoint_data(*args, **kwargs):
-    url = 'https://opendata.fmi.fi/wfs'
-    wfs = WebFeatureService(url=url, version='2.0.0')
     params = {}
     timestep = kwargs.pop('timestep', None)
     if timestep:
@@ -192,6 +476,8 @@ def get_fmi_multipoint_data(*args, **kwargs):
     if max_locations:
         params['maxlocations'] = max_locations
 
+    as_frame = kwargs.pop('as_frame', False)
+
     if kwargs:
         raise Exception("Unknown kwargs: %s" % (', '.join(kwargs.keys())))
 
@@ -199,42 +485,13 @@ def get_fmi_multipoint_data(*args, **kwargs):
     if len(args) > 1:
         raise Exception("Unknown kwargs: %s" % (', '.join(args)))
 
-    resp = wfs.getfeature(storedQueryID=query_id, storedQueryParams=params)
-    data = resp.read()
-    if isinstance(data, str):
-        print(data)
-        data = bytes(data, encoding='utf8')
-
-    root = etree.fromstring(data)
-
-    result_time = root.find('.//{*}resultTime//{*}timePosition').text
-    result_time = dateutil.parser.parse(result_time).astimezone(LOCAL_TZ)
-
-    positions = root.find('.//{*}positions').text
-    observations = root.find('.//{*}DataBlock/{*}doubleOrNilReasonTupleList').text
-    fields = root.findall('.//{*}DataRecord/{*}field')
-    field_names = [x.attrib['name'] for x in fields]
-
-    points = root.findall('.//{*}MultiPoint//{*}Point')
-    point_by_coords = {}
-    for el in points:
-        pos = el.find('{*}pos').text.strip()
-        name = el.find('{*}name').text
-        point_by_coords[pos] = dict(name=name, coords=[float(x) for x in pos.split()])
-
-    positions = [re.findall(r'\S+', x.strip()) for x in positions.splitlines() if x.strip()]
-    observations = [re.findall(r'\S+', x.strip()) for x in observations.splitlines() if x.strip()]
-
-    data = []
-    for pos, obs in zip(positions, observations):
-        d = {field_name: float(sample) for field_name, sample in zip(field_names, obs)}
-        for key, val in d.items():
-            if math.isnan(val):
-                d[key] = None
-        ts = datetime.fromtimestamp(int(pos[2]))
-        d['time'] = LOCAL_TZ.localize(ts)
-        d['location'] = point_by_coords['%s %s' % (pos[0], pos[1])]
-        data.append(d)
+    with open_wfs_query(query_id, params) as resp:
+        result_time, df = parse_multipoint_coverage(resp.raw)
+
+    if as_frame:
+        # Columnar results: one row per station and time
+        return dict(observations=df, meta=dict(result_time=result_time))
+    data = _coverage_to_observations(df)
 
     return dict(observations=data, meta=dict(result_time=result_time))
 
@@ -364,7 +621,170 @@ def read_observations(obs_type):
     #send_to_influxdb(data['observations'], 'Kumpula')
     """
 
+# FMI allows 600 requests per 5 minutes for open data
+API_REQUESTS_PER_MINUTE = 120
+
+OBSERVATION_ARCHIVE_DIR = os.path.join(settings.DATA_DIR, 'fmi/observations')
+OBSERVATION_QUERIES = {
+    'weather': 'fmi::observations::weather::multipointcoverage',
+    'radiation': 'fmi::observations::radiation::multipointcoverage',
+}
+
+
+def _get_archive_dir(obs_type, fmi_sid):
+    return os.path.join(OBSERVATION_ARCHIVE_DIR, obs_type, 'fmisid=%s' % fmi_sid)
+
+
+def _get_fragment_path(obs_type, fmi_sid, start_date, end_date, complete):
+    name = '%s_%s' % (start_date.isoformat(), end_date.isoformat())
+    if not complete:
+        # Windows that may still get new data are fetched again later
+        name += '.partial-%d' % time.time_ns()
+    return os.path.join(_get_archive_dir(obs_type, fmi_sid), 'year=%d' % start_date.year, name + '.parquet')
+
+
+def _fetch_observation_window(obs_type, fmi_sid, start_date, end_date, props, rate_limiter):
+    rate_limiter.acquire()
+    data = get_fmi_multipoint_data(
+        OBSERVATION_QUERIES[obs_type], fmi_sid=fmi_sid, timestep=60, start_time=start_date,
+        end_time=end_date, max_locations=1, as_frame=True,
+    )
+    df = data['observations'].drop(columns=['lat', 'lon']).rename(columns={'station': 'location'})
+    labels = {col: props[col.lower()]['label'] for col in df.columns if col.lower() in props}
+    return df.rename(columns=labels)
+
+
+def archive_observations(obs_type, fmi_sid=101004, start_date=date(2016, 1, 1), end_date=None,
+                         window_days=6, workers=4):
+    """Fetch hourly observations of a station into an append-only archive.
+
+    The date range is split into `window_days` windows that are fetched
+    concurrently within the API rate limit. Each window is written as its
+    own Parquet fragment under <type>/fmisid=<sid>/year=<year>/ and never
+    rewritten; windows that are complete are recorded in a checkpoint and
+    skipped on later runs. Overlaps are removed by
+    `compact_observation_archive()`.
+    """
+    if obs_type not in OBSERVATION_QUERIES:
+        raise Exception('invalid observation type: %s' % obs_type)
+    if end_date is None:
+        end_date = date.today() + timedelta(days=1)
+    # Observations of the last couple of days may still be amended
+    complete_before = date.today() - timedelta(days=1)
+
+    archive_dir = _get_archive_dir(obs_type, fmi_sid)
+    checkpoint = Checkpoint(os.path.join(archive_dir, 'windows.checkpoint'))
+    windows = []
+    window_start = start_date
+    while window_start < end_date:
+        window_end = window_start + timedelta(days=window_days)
+        if window_start.isoformat() not in checkpoint:
+            windows.append((window_start, window_end))
+        window_start = window_end
+
+    props = get_meta('eng', 'observation')
+    rate_limiter = TokenBucket.per_minute(API_REQUESTS_PER_MINUTE)
+    meter = ThroughputMeter(total=len(windows), tag='FMI %s %s' % (obs_type, fmi_sid))
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                _fetch_observation_window, obs_type, fmi_sid, window_start, window_end, props, rate_limiter
+            ): (window_start, window_end) for window_start, window_end in windows
+        }
+        for future in as_completed(futures):
+            window_start, window_end = futures[future]
+            try:
+                df = future.result()
+            except Exception as e:
+                print('%s - %s failed: %s' % (window_start, window_end, e))
+                failed.append(window_start)
+                continue
+            complete = window_end < complete_before
+            path = _get_fragment_path(obs_type, fmi_sid, window_start, window_end, complete)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            df.to_parquet(path + '.tmp', engine='fastparquet', compression='zstd', index=False)
+            os.replace(path + '.tmp', path)
+            if complete:
+                checkpoint.mark_done(window_start.isoformat())
+            meter.update(len(df))
+            if meter.done % 50 == 0:
+                print(meter.format())
+
+    print(meter.format())
+    if failed:
+        raise Exception('%d of %d windows failed' % (len(failed), len(windows)))
+
+
+def _read_archive_partition(partition_dir):
+    """Read and de-duplicate all the files of one year of the archive"""
+    def sort_key(file_name):
+        if file_name == 'compacted.parquet':
+            return ('', 0, 0)
+        # Partial fragments of a window first, in fetch order, then the complete one
+        window, _, partial = file_name[:-len('.parquet')].partition('.partial-')
+        return (window, 0 if partial else 1, int(partial or 0))
+
+    file_names = sorted([x for x in os.listdir(partition_dir) if x.endswith('.parquet')], key=sort_key)
+    if not file_names:
+        return None, []
+    dfs = [pd.read_parquet(os.path.join(partition_dir, x), engine='fastparquet') for x in file_names]
+    df = pd.concat(dfs, ignore_index=True, sort=False)
+    df = df.drop_duplicates(['location', 'time'], keep='last').sort_values('time', ignore_index=True)
+    return df, file_names
+
+
+def compact_observation_archive(obs_type, fmi_sid=101004):
+    """Merge the fragments of each year of the archive into one file"""
+    archive_dir = _get_archive_dir(obs_type, fmi_sid)
+    for year_dir in sorted(os.listdir(archive_dir)):
+        partition_dir = os.path.join(archive_dir, year_dir)
+        if not year_dir.startswith('year=') or not os.path.isdir(partition_dir):
+            continue
+        df, file_names = _read_archive_partition(partition_dir)
+        if file_names == ['compacted.parquet'] or df is None:
+            continue
+        path = os.path.join(partition_dir, 'compacted.parquet')
+        df.to_parquet(path + '.tmp', engine='fastparquet', compression='zstd', index=False)
+        os.replace(path + '.tmp', path)
+        for file_name in file_names:
+            if file_name != 'compacted.parquet':
+                os.remove(os.path.join(partition_dir, file_name))
+
+
+def read_observation_archive(obs_type, fmi_sid=101004, start_time=None, end_time=None):
+    """Read observations from the archive, de-duplicated and sorted by time"""
+    archive_dir = _get_archive_dir(obs_type, fmi_sid)
+    dfs = []
+    for year_dir in sorted(os.listdir(archive_dir)):
+        if not year_dir.startswith('year='):
+            continue
+        year = int(year_dir.split('=')[1])
+        # A window starting in one year may reach into the next
+        if start_time is not None and year < start_time.year - 1:
+            continue
+        if end_time is not None and year > end_time.year:
+            continue
+        df, _ = _read_archive_partition(os.path.join(archive_dir, year_dir))
+        if df is not None:
+            dfs.append(df)
+    if not dfs:
+        return None
+
+    df = pd.concat(dfs, ignore_index=True, sort=False)
+    df = df.drop_duplicates(['location', 'time'], keep='last').sort_values('time', ignore_index=True)
+    if start_time is not None:
+        df = df[df['time'] >= start_time]
+    if end_time is not None:
+        df = df[df['time'] < end_time]
+    return df.reset_index(drop=True)
+
+
 if __name__ == '__main__':
+    archive_observations('weather')
+    compact_observation_archive('weather')
+    exit()
+
     read_observations('weather')
     exit()
 
@@ -313,6 +313,20 @@ def get_car_unit_emissions():
     return pd.DataFrame(list(series), index=index, columns=['emission_factor'])
 
 
+def calculate_unit_emissions(liisa_df, municipality, year=None):
+    """Return CO2e unit emissions (g/km) by vehicle and road type.
+
+    `liisa_df` is in the format returned by `get_all_liisa_data()`. If
+    `year` is not given, the latest year in the data is used.
+    """
+    df = liisa_df[liisa_df.Municipality == municipality]
+    if year is None:
+        year = df.Year.max()
+    df = df[df.Year == year].set_index(['Vehicle', 'Road'])
+    # CO2e is in tonnes and mileage in km
+    return (df['CO2e'] * 1000000 / df['Mileage']).rename('CO2e')
+
+
 def get_all_liisa_data():
     dfs = []
 
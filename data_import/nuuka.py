@@ -1,16 +1,24 @@
+import io
 import re
 import os
 import json
 import time
 import random
-from datetime import date, timedelta, datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
 from pprint import pprint
 
+import fastparquet
 import pandas as pd
 import requests
 import requests_cache
 import pytz
 
+from utils.checkpoint import Checkpoint
+from utils.http import get_http_session
+from utils.perf import ThroughputMeter
+
 
 #requests_cache.install_cache('nuuka')
 
@@ -20,8 +28,22 @@ _api_key = None
 
 LOCAL_TZ = pytz.timezone('Europe/Helsinki')
 
+DATA_DIR = 'data/nuuka'
+FETCH_WINDOW_DAYS = 30
+# Request windows are sized to return about this many rows
+TARGET_RESPONSE_ROWS = 20000
+# Responses with this many rows are assumed to be truncated by the API
+MAX_RESPONSE_ROWS = 100000
+
+# Measurements of all buildings, partitioned as category=/year=/building_id=
+DATASET_DIR = '%s/measurements' % DATA_DIR
+DATASET_PARTITIONS = ['category', 'year', 'building_id']
+DATASET_ROW_GROUP_SIZE = 100000
+
+_dataset_lock = threading.Lock()
 
-def api_get(path, req_params=None):
+
+def api_get(path, req_params=None, session=None, raw=False):
     assert _api_key and _api_base_url
 
     params = {}
@@ -30,8 +52,10 @@ def api_get(path, req_params=None):
     params['$token'] = _api_key
     params['$format'] = 'json'
 
-    resp = requests.get('%s%s/' % (_api_base_url, path), params=params)
+    resp = (session or requests).get('%s%s/' % (_api_base_url, path), params=params)
     resp.raise_for_status()
+    if raw:
+        return resp.content
     return resp.json()
 
 
@@ -43,50 +67,53 @@ def set_api_params(base_url, api_key):
     _api_key = api_key
 
 
-def get_measurement_data(building_id, data_point_ids, start_date, end_date):
+def _parse_measurement_json(content):
+    """Decode a measurement data response into a DataFrame.
+
+    The whole response is decoded into columns at once and the UTC
+    timestamps are converted into a `time` column in one vectorized
+    operation.
+    """
+    df = pd.read_json(io.BytesIO(content), orient='records', convert_dates=False, dtype=False)
+    if not len(df):
+        return pd.DataFrame(dict(
+            DataPointID=pd.Series([], dtype='int64'), Value=pd.Series([], dtype=float),
+            time=pd.Series([], dtype=pd.DatetimeTZDtype(tz=LOCAL_TZ)),
+        ))
+    df['time'] = pd.to_datetime(df['Timestamp'], format='%Y-%m-%dT%H:%M:%S', utc=True).dt.tz_convert(LOCAL_TZ)
+    return df
+
+
+def get_measurement_data(building_id, data_point_ids, start_date, end_date, session=None):
     params = dict(Building=building_id, DataPointIDs=';'.join([str(x) for x in data_point_ids]))
     params['StartTime'] = start_date.isoformat()
     params['EndTime'] = end_date.isoformat()
     params['TimestampTimeZone'] = 'UTC'
-    print(data_point_ids)
-    resp = api_get('GetMeasurementDataByIDs', params)
-    out = []
-    for d in resp:
-        #assert d['Name'] is None
-        if 'Target' not in d:
-            pprint(d)
-        assert d['Target'] is None
-        dt = datetime.strptime(d['Timestamp'], "%Y-%m-%dT%H:%M:%S")
-        dt = pytz.utc.localize(dt)
-        dt = dt.astimezone(LOCAL_TZ)
-        val = d['Value']
-        dpid = d['DataPointID']
-        out.append(dict(building_id=building_id, sensor_id=dpid, time=dt, value=val))
-
-    df = pd.DataFrame.from_records(out)
+    content = api_get('GetMeasurementDataByIDs', params, session=session, raw=True)
+    resp = _parse_measurement_json(content)
+    if len(resp):
+        #assert resp['Name'].isna().all()
+        assert 'Target' in resp.columns and resp['Target'].isna().all()
+
+    df = pd.DataFrame(dict(
+        building_id=building_id, sensor_id=resp['DataPointID'], time=resp['time'], value=resp['Value']
+    ))
     return df
 
 
-def get_daily_measurement_data(building_id, data_point_ids, start_date, end_date):
+def get_daily_measurement_data(building_id, data_point_ids, start_date, end_date, session=None):
     params = dict(Building=building_id, DataPointIDs=';'.join([str(x) for x in data_point_ids]))
     params['StartTime'] = start_date.isoformat()
     params['EndTime'] = end_date.isoformat()
     params['TimestampTimeZone'] = 'UTC'
-    resp = api_get('GetDailyMeasurementData', params)
-    out = []
-    for d in resp:
-        dt = datetime.strptime(d['Timestamp'], "%Y-%m-%dT%H:%M:%S")
-        dt = pytz.utc.localize(dt)
-        dt = dt.astimezone(LOCAL_TZ)
-        val = d['Value']
-        dpid = d['DataPointID']
-        unit = d.get('Unit')
-        d = dict(sensor_id=dpid, time=dt, value=val)
-        if unit:
-            d['unit'] = unit
-        out.append(d)
-
-    df = pd.DataFrame.from_records(out)
+    content = api_get('GetDailyMeasurementData', params, session=session, raw=True)
+    resp = _parse_measurement_json(content)
+
+    df = pd.DataFrame(dict(sensor_id=resp['DataPointID'], time=resp['time'], value=resp['Value']))
+    if 'Unit' in resp.columns:
+        unit = resp['Unit'].where(resp['Unit'].fillna('') != '')
+        if unit.notna().any():
+            df['unit'] = unit
     return df
 
 
@@ -170,44 +197,50 @@ def get_buildings():
     return out
 
 
-def _determine_data_start_old(building_id, data_point_id):
-    from utils.data_import import find_data_start
+def _determine_data_start_old(building_id, data_point_id, session=None):
+    from utils.data_import import find_data_start_parallel
 
     def check_date(date):
-        print(building_id, data_point_id)
+        print(building_id, data_point_id, date)
         resp = get_daily_measurement_data(
-            building_id, [data_point_id], date, date + timedelta(days=1)
+            building_id, [data_point_id], date, date + timedelta(days=1), session=session
         )
         if len(resp) < 1 or len(resp.time.unique()) <= 1:
             return False
         else:
             return True
 
+    memo = {}
+
+    def probe(date):
+        if date not in memo:
+            memo[date] = check_date(date)
+        return memo[date]
+
     guesses = (date(2016, 1, 1), date(2017, 1, 1), date(2019, 5, 26))
     for guess in guesses:
-        if check_date(guess):
+        if probe(guess):
             prev_day = guess - timedelta(days=1)
-            if not check_date(prev_day):
+            if not probe(prev_day):
                 return guess
 
     should_be_valid = date.today() - timedelta(days=2)
-    if not check_date(should_be_valid):
+    if not probe(should_be_valid):
         return None
 
-    ds = find_data_start(
-        check_date, max_date=date.today() - timedelta(days=2),
-        min_date=date(2015, 1, 1)
+    ds = find_data_start_parallel(
+        check_date, max_date=should_be_valid, min_date=date(2015, 1, 1), memo=memo
     )
 
     return ds
 
 
-def _determine_data_start(building_id, data_point_id):
+def _determine_data_start(building_id, data_point_id, session=None):
     for year in (2016, 2017, 2018, 2019):
         start = date(year, 1, 1)
         end = date(year, 12, 31)
         resp = get_daily_measurement_data(
-            building_id, [data_point_id], start, end
+            building_id, [data_point_id], start, end, session=session
         )
         if len(resp) == 0:
             continue
@@ -220,7 +253,7 @@ def _determine_data_start(building_id, data_point_id):
 
 
 def load_buildings():
-    with open('data/nuuka/buildings.json', 'r') as f:
+    with open('%s/buildings.json' % DATA_DIR, 'r') as f:
         data = json.load(f)
 
     return data
@@ -243,41 +276,316 @@ def _sensor_ok(sensor):
     return True
 
 
-def get_all_measurements_for_building(building):
-    sensors = [s for s in building['sensors'] if _sensor_ok(s)]
+def _get_building_sensors(building):
+    return [s for s in building.get('sensors', []) if _sensor_ok(s)]
+
+
+class WindowPlanner:
+    """Choose request windows for a date range from the observed data density.
+
+    The next window is sized so that it is expected to return about
+    `target_rows` rows, based on the rows per day seen in the previous
+    window. Windows are contiguous (the end of one is the start of the
+    next), so no days are skipped. A response with `max_rows` or more rows
+    is assumed to be truncated and the same window is planned again at
+    half the length.
+    """
+
+    def __init__(self, start_date, end_date, target_rows=None, max_rows=None,
+                 initial_days=FETCH_WINDOW_DAYS, min_days=1, max_days=366):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.target_rows = target_rows or TARGET_RESPONSE_ROWS
+        self.max_rows = max_rows or MAX_RESPONSE_ROWS
+        self.min_days = min_days
+        self.max_days = max_days
+        self.days = initial_days
+        self.current = None
+
+    def next_window(self):
+        """Return the next (start_date, end_date) window or None when done"""
+        if self.current is None:
+            if self.start_date >= self.end_date:
+                return None
+            window_end = min(self.start_date + timedelta(days=self.days), self.end_date)
+            self.current = (self.start_date, window_end)
+        return self.current
+
+    def record(self, rows):
+        """Record the row count of the current window and plan the next one"""
+        start_date, end_date = self.current
+        days = (end_date - start_date).days
+        self.current = None
+        if self.max_rows and rows >= self.max_rows and days > self.min_days:
+            # Probably truncated; retry the same window with a shorter one
+            self.days = max(self.min_days, days // 2)
+            return False
+
+        if rows:
+            new_days = int(self.target_rows * days / rows)
+        else:
+            new_days = days * 4
+        # Do not let one odd window change the length too abruptly
+        new_days = max(days // 4, min(days * 4, new_days))
+        self.days = max(self.min_days, min(self.max_days, new_days))
+        self.start_date = end_date
+        return True
+
+    def __iter__(self):
+        """Iterate over the windows; `record()` must be called for each"""
+        while True:
+            window = self.next_window()
+            if window is None:
+                return
+            yield window
+
+
+def get_building_date_range(building):
+    sensors = _get_building_sensors(building)
     if not sensors:
         return None
 
     min_date = date.fromisoformat(min([s['data_start_date'] for s in sensors]))
-    last_date = date.today() - timedelta(days=1)
-    start_date = min_date
+    return min_date, date.today()
 
-    dfs = []
 
-    while start_date < last_date:
-        print(start_date)
-        end_date = start_date + timedelta(days=30)
-        sensor_ids = [s['id'] for s in sensors]
-        df = get_measurement_data(building['id'], sensor_ids, start_date, end_date)
-        start_date = end_date + timedelta(days=1)
+def get_all_measurements_for_building(building, session=None):
+    date_range = get_building_date_range(building)
+    if date_range is None:
+        return None
+
+    sensor_ids = [s['id'] for s in _get_building_sensors(building)]
+    dfs = []
+    planner = WindowPlanner(*date_range)
+    for start_date, end_date in planner:
+        print(start_date, end_date)
+        df = get_measurement_data(building['id'], sensor_ids, start_date, end_date, session=session)
+        if not planner.record(len(df)):
+            continue
         if len(df) < 5:
             continue
         dfs.append(df)
 
     if not dfs:
-        open('data/nuuka/%s.nodata' % building['id'], 'a').close()
+        open('%s/%s.nodata' % (DATA_DIR, building['id']), 'a').close()
         return
 
     all_dfs = pd.concat(dfs, ignore_index=True)
+    # The window boundaries may be included in both of the adjacent windows
+    all_dfs = all_dfs.drop_duplicates(['sensor_id', 'time'], keep='last', ignore_index=True)
     return all_dfs
 
 
-def fetch_all():
+def _get_window_key(building_id, start_date, end_date):
+    return '%s:%s:%s' % (building_id, start_date.isoformat(), end_date.isoformat())
+
+
+def _get_resume_date(checkpoint, building_id):
+    """Return the end of the last checkpointed window of a building"""
+    prefix = '%s:' % building_id
+    ends = [key.split(':')[2] for key in checkpoint.keys() if key.startswith(prefix)]
+    return date.fromisoformat(max(ends)) if ends else None
+
+
+def _get_parts_dir(building_id):
+    return '%s/parts/%s' % (DATA_DIR, building_id)
+
+
+def _fetch_window(building, start_date, end_date, session):
+    """Download one request window of a building into its own part file"""
+    sensor_ids = [s['id'] for s in _get_building_sensors(building)]
+    df = get_measurement_data(building['id'], sensor_ids, start_date, end_date, session=session)
+    return df
+
+
+def _save_window(building, start_date, end_date, df):
+    path = '%s/%s_%s.parquet' % (_get_parts_dir(building['id']), start_date.isoformat(), end_date.isoformat())
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
+def write_measurement_dataset(df, building):
+    """Append the measurements of one building to the partitioned dataset.
+
+    Rows are sorted by sensor and time within each partition, so the
+    row-group statistics of `time` and `sensor_id` are tight enough to
+    skip row groups when reading.
+    """
+    categories = {s['id']: s['category'] for s in building['sensors']}
+    df = df.assign(
+        building_id=building['id'],
+        category=df['sensor_id'].map(categories),
+        year=df['time'].dt.year,
+    )
+    df = df.sort_values(['category', 'year', 'sensor_id', 'time'], ignore_index=True)
+
+    with _dataset_lock:
+        fastparquet.write(
+            DATASET_DIR, df, partition_on=DATASET_PARTITIONS, file_scheme='hive',
+            row_group_offsets=DATASET_ROW_GROUP_SIZE, compression='zstd', stats=True,
+            write_index=False, append=os.path.exists('%s/_metadata' % DATASET_DIR),
+        )
+
+
+def read_measurements(building_ids=None, sensor_ids=None, categories=None, start_time=None,
+                      end_time=None, columns=None):
+    """Read measurements from the partitioned dataset.
+
+    The filters are pushed down to fastparquet, so only the matching
+    partitions are opened and row groups whose statistics fall outside
+    the filters are skipped. `end_time` is exclusive.
+    """
+    if start_time is not None:
+        start_time = pd.Timestamp(start_time)
+        if start_time.tz is None:
+            start_time = start_time.tz_localize(LOCAL_TZ)
+    if end_time is not None:
+        end_time = pd.Timestamp(end_time)
+        if end_time.tz is None:
+            end_time = end_time.tz_localize(LOCAL_TZ)
+
+    filters = []
+    if categories is not None:
+        filters.append(('category', 'in', list(categories)))
+    if building_ids is not None:
+        filters.append(('building_id', 'in', [int(x) for x in building_ids]))
+    if sensor_ids is not None:
+        filters.append(('sensor_id', 'in', [int(x) for x in sensor_ids]))
+    # The time statistics are stored as naive UTC
+    if start_time is not None:
+        filters += [
+            ('year', '>=', start_time.year),
+            ('time', '>=', start_time.tz_convert('UTC').tz_localize(None)),
+        ]
+    if end_time is not None:
+        filters += [
+            ('year', '<=', end_time.year),
+            ('time', '<', end_time.tz_convert('UTC').tz_localize(None)),
+        ]
+
+    pf = fastparquet.ParquetFile(DATASET_DIR)
+    read_columns = None
+    if columns is not None:
+        # The filter columns are needed for filtering the rows of the row groups
+        read_columns = list(dict.fromkeys(list(columns) + [f[0] for f in filters]))
+    df = pf.to_pandas(columns=read_columns, filters=filters)
+
+    if 'time' in df.columns:
+        df['time'] = df['time'].dt.tz_convert(LOCAL_TZ)
+    for col in ('category', 'year', 'building_id'):
+        if col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(str if col == 'category' else int)
+
+    mask = pd.Series(True, index=df.index)
+    if sensor_ids is not None:
+        mask &= df['sensor_id'].isin([int(x) for x in sensor_ids])
+    if start_time is not None:
+        mask &= df['time'] >= start_time
+    if end_time is not None:
+        mask &= df['time'] < end_time
+    if not mask.all():
+        df = df[mask]
+    if columns is not None:
+        df = df[list(columns)]
+    return df.reset_index(drop=True)
+
+
+def migrate_building_files():
+    """Move measurements from the old per-building files into the dataset"""
+    for b in load_buildings():
+        path = '%s/%s.parquet' % (DATA_DIR, b['id'])
+        if not os.path.exists(path):
+            continue
+        print(path)
+        write_measurement_dataset(pd.read_parquet(path), b)
+        open('%s/%s.fetched' % (DATA_DIR, b['id']), 'a').close()
+        os.remove(path)
+
+
+def _is_building_fetched(building):
+    return any(os.path.exists('%s/%s.%s' % (DATA_DIR, building['id'], ext)) for ext in ('fetched', 'nodata', 'parquet'))
+
+
+def _finish_building(building):
+    """Add the downloaded windows of a building to the dataset"""
+    parts_dir = _get_parts_dir(building['id'])
+    paths = []
+    if os.path.exists(parts_dir):
+        paths = sorted(os.path.join(parts_dir, x) for x in os.listdir(parts_dir) if x.endswith('.parquet'))
+
+    if not paths:
+        open('%s/%s.nodata' % (DATA_DIR, building['id']), 'a').close()
+    else:
+        df = pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+        # The window boundaries may be included in both of the adjacent windows
+        df = df.drop_duplicates(['sensor_id', 'time'], keep='last', ignore_index=True)
+        write_measurement_dataset(df, building)
+        open('%s/%s.fetched' % (DATA_DIR, building['id']), 'a').close()
+
+    for path in paths:
+        os.remove(path)
+
+
+def _fetch_building(building, checkpoint, meter, session):
+    date_range = get_building_date_range(building)
+    if date_range is not None:
+        start_date, end_date = date_range
+        start_date = _get_resume_date(checkpoint, building['id']) or start_date
+        planner = WindowPlanner(start_date, end_date)
+        for window_start, window_end in planner:
+            df = _fetch_window(building, window_start, window_end, session)
+            if not planner.record(len(df)):
+                continue
+            if len(df) >= 5:
+                _save_window(building, window_start, window_end, df)
+            checkpoint.mark_done(_get_window_key(building['id'], window_start, window_end))
+            meter.update(len(df), done=0)
+    _finish_building(building)
+    meter.update(0)
+
+
+def fetch_building_windows(buildings, workers=8, session=None):
+    """Download the measurements of `buildings` concurrently.
+
+    Buildings are fetched in parallel on a thread pool sharing one pooled
+    HTTP session, so at most `workers` requests are in flight at a time.
+    The windows of each building are planned with `WindowPlanner`.
+    Finished windows are stored as part files and recorded in a
+    checkpoint, so an interrupted run continues from the last finished
+    window of each building. Returns the throughput meter.
+    """
+    if session is None:
+        session = get_http_session(pool_size=workers)
+    checkpoint = Checkpoint('%s/fetch.checkpoint' % DATA_DIR)
+
+    buildings = [b for b in buildings if not _is_building_fetched(b)]
+    meter = ThroughputMeter(total=len(buildings), tag='nuuka')
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_fetch_building, b, checkpoint, meter, session): b for b in buildings}
+        for future in as_completed(futures):
+            b = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print('%s failed: %s' % (b['id'], e))
+                failed.append(b['id'])
+                continue
+            print(meter.format())
+
+    if failed:
+        raise Exception('Fetching %d buildings failed' % len(failed))
+    return meter
+
+
+def fetch_all(workers=8):
     buildings = load_buildings()
 
     df = pd.DataFrame.from_records(buildings)
     df = df.drop(columns=['geometry', 'sensors']).set_index('id')
-    df.to_parquet('data/nuuka/buildings.parquet')
+    df.to_parquet('%s/buildings.parquet' % DATA_DIR)
 
     sensors = []
     for b in buildings:
@@ -286,8 +594,10 @@ def fetch_all():
             s['building_id'] = b['id']
             sensors.append(s)
     df = pd.DataFrame.from_records(sensors).set_index('id')
-    df.to_parquet('data/nuuka/sensors.parquet')
+    df.to_parquet('%s/sensors.parquet' % DATA_DIR)
 
+    session = get_http_session(pool_size=workers)
+    pending = []
     for b in buildings:
         #if b['type_id'] not in (5, 6, 7, 47, 15):
         #    continue
@@ -295,7 +605,7 @@ def fetch_all():
         #    continue
         if 'sensors' not in b:
             continue
-        if os.path.exists('data/nuuka/%s.parquet' % b['id']) or os.path.exists('data/nuuka/%s.nodata' % b['id']):
+        if _is_building_fetched(b):
             continue
         print('%s: %s' % (b['id'], b['description']))
         changed = False
@@ -306,7 +616,7 @@ def fetch_all():
                 continue
             data_start = s.get('data_start_date')
             if not s.get('data_start_date'):
-                data_start = _determine_data_start(b['id'], s['id'])
+                data_start = _determine_data_start(b['id'], s['id'], session=session)
                 s['data_start_date'] = data_start.isoformat() if data_start else None
                 changed = True
             if not data_start:
@@ -315,15 +625,13 @@ def fetch_all():
 
         if changed:
             out = json.dumps(buildings, indent=4, ensure_ascii=False)
-            with open('data/nuuka/buildings.json', 'w') as f:
+            with open('%s/buildings.json' % DATA_DIR, 'w') as f:
                 f.write(out)
 
-        print('getting all measurements for %s' % b['id'])
-        ret = get_all_measurements_for_building(b)
-        if ret is None:
-            open('data/nuuka/%s.nodata' % b['id'], 'a').close()
-        else:
-            ret.to_parquet('data/nuuka/%s.parquet' % b['id'], index=False)
+        pending.append(b)
+
+    print('getting all measurements for %d buildings' % len(pending))
+    fetch_building_windows(pending, workers=workers, session=session)
 
 
 if __name__ == '__main__':
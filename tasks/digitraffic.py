@@ -1,6 +1,6 @@
 import os
-import json
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 import luigi
@@ -8,43 +8,78 @@ import pandas as pd
 from tzlocal import get_localzone
 
 from data_import import digitraffic
+from utils.checkpoint import Checkpoint
+from utils.http import get_http_session
+from utils.perf import ThroughputMeter
 import settings
 
-from .targets.timescaledb import TimescaleDBTarget
+from .targets.timescaledb import TimescaleDBTarget, find_complete_targets
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-stations_by_name = None
+STATION_CACHE_PATH = 'digitraffic/tms_stations.json'
 
+_station_registry = None
 
-def load_selected_stations():
-    global stations_by_name
 
-    if stations_by_name is not None:
-        return
+def get_station_registry():
+    """Return the station registry, loaded from the disk cache.
 
-    task = DigitrafficTMSStations()
-    if not task.complete():
-        task.run()
+    The network is only used if there is no cache at all; refreshing a
+    stale cache is left to DigitrafficTMSStations.
+    """
+    global _station_registry
 
-    with task.output().open('r') as in_file:
-        stations = json.load(in_file)
+    if _station_registry is None:
+        registry = digitraffic.StationRegistry(os.path.join(settings.DATA_DIR, STATION_CACHE_PATH))
+        if not registry.load():
+            registry.refresh()
+        _station_registry = registry
+    return _station_registry
 
-    stations_by_name = {s['name']: s for s in stations}
 
-    return stations
+def load_selected_stations():
+    return get_station_registry().in_municipality(settings.MUNICIPALITY_ID)
 
 
 def get_station_by_name(station_name):
-    load_selected_stations()
-
-    if station_name not in stations_by_name:
-        station_names = ', '.join(sorted(stations_by_name.keys()))
+    station = get_station_registry().get_by_name(station_name)
+    muni_id = int(settings.MUNICIPALITY_ID)
+    if station is None or not station['municipality_code'] or int(station['municipality_code']) != muni_id:
+        station_names = ', '.join(sorted(s['name'] for s in load_selected_stations()))
         raise Exception('Invalid station name: %s\nChoices: %s' % (station_name, station_names))
-    return stations_by_name[station_name]
+    return station
+
+
+def get_station_location_names(station):
+    directions = [station['direction%d_municipality' % i] for i in (1, 2)]
+    return ['%s_(%s)' % (station['name'], d) for d in directions]
+
+
+def get_daily_target(station, date):
+    local_tz = digitraffic.LOCAL_TZ
+    start_time = local_tz.localize(datetime.combine(date, datetime.min.time()))
+    end_time = local_tz.localize(datetime.combine(date, datetime.max.time()))
+    return DigitrafficTarget(
+        settings.POSTGRESQL_DSN, start_time=start_time, end_time=end_time,
+        locations=get_station_location_names(station)
+    )
+
+
+def load_station_file(path):
+    """Read and validate a file with one station name per line"""
+    stations = []
+    with open(path, 'r') as f:
+        for line in f.readlines():
+            station = line.strip()
+            if not station:
+                continue
+            get_station_by_name(station)
+            stations.append(station)
+    return stations
 
 
 class DigitrafficTarget(TimescaleDBTarget):
@@ -52,6 +87,64 @@ class DigitrafficTarget(TimescaleDBTarget):
     value_columns = [(x, int) for x in digitraffic.VEHICLE_CLASSES.values()]
     location_column = 'station_direction'
     interval = 60
+    continuous_aggregates = {'hourly': '1 hour', 'daily': '1 day'}
+    compress_after = '30 days'
+    # Emissions are recomputed for the hours whose counts changed
+    log_writes = True
+
+
+class DigitrafficConfig(luigi.Config):
+    # 'parquet' stores each parsed station-day as a compressed, typed
+    # Parquet file instead of the raw CSV text
+    raw_format = luigi.ChoiceParameter(choices=['csv', 'parquet'], default='csv')
+
+
+RAW_CSV_PATH = 'digitraffic/lam/%(year)d/%(month)d/%(day)d/%(station)s.csv'
+RAW_PARQUET_PATH = 'digitraffic/lam-parquet/%(year)d/%(station)s/%(date)s.parquet'
+
+
+def get_raw_data_path(station_name, date, raw_format):
+    path_format = RAW_PARQUET_PATH if raw_format == 'parquet' else RAW_CSV_PATH
+    path = path_format % dict(
+        year=date.year, month=date.month, day=date.day, station=station_name, date=date.isoformat()
+    )
+    return os.path.join(settings.DATA_DIR, path)
+
+
+def write_raw_parquet(target, df):
+    # fastparquet reads a tz-aware DatetimeIndex back as 1970-01-01, so the
+    # time is stored as a regular column
+    with target.temporary_path() as path:
+        df.reset_index().to_parquet(path, engine='fastparquet', compression='zstd', index=False)
+
+
+def _read_raw_parquet_file(path, columns=None):
+    if columns is not None:
+        columns = ['time'] + [c for c in columns if c != 'time']
+    # Files written before the time column change have it as the index;
+    # with index=False it is read as a regular column from those as well.
+    df = pd.read_parquet(path, engine='fastparquet', columns=columns, index=False)
+    df['time'] = df['time'].dt.tz_convert(digitraffic.LOCAL_TZ)
+    return df.set_index('time')
+
+
+def read_raw_parquet(station_name, start_date, end_date=None, columns=None):
+    """Read parsed vehicle passages of a station from the Parquet store.
+
+    Returns the passages from `start_date` to `end_date` (inclusive) for
+    the days that have been stored.
+    """
+    if end_date is None:
+        end_date = start_date
+    dfs = []
+    for date in pd.date_range(start_date, end_date).date:
+        path = get_raw_data_path(station_name, date, 'parquet')
+        if not os.path.exists(path):
+            continue
+        dfs.append(_read_raw_parquet_file(path, columns=columns))
+    if not dfs:
+        return None
+    return pd.concat(dfs)
 
 
 class DigitrafficVehicleCountRaw(luigi.Task):
@@ -61,16 +154,32 @@ class DigitrafficVehicleCountRaw(luigi.Task):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.station = get_station_by_name(self.station_name)
+        self.raw_format = DigitrafficConfig().raw_format
 
     def output(self):
-        date = self.date
-        path = 'digitraffic/lam/%d/%d/%d/%s.csv' % (date.year, date.month, date.day, self.station_name)
-        return luigi.LocalTarget(os.path.join(settings.DATA_DIR, path))
+        return luigi.LocalTarget(get_raw_data_path(self.station_name, self.date, self.raw_format))
+
+    def download(self, session=None):
+        content = digitraffic.fetch_tms_station_raw_data('01', self.station['id'], self.date, session=session)
+        # LocalTarget writes to a temporary file and renames it in place
+        if self.raw_format == 'parquet':
+            df = digitraffic.parse_tms_station_raw_data(self.station['id'], self.date, content)
+            write_raw_parquet(self.output(), df)
+        else:
+            with self.output().open('w') as out:
+                out.write(content)
+        return content.count('\n')
+
+    def read(self):
+        """Return the parsed vehicle passages of the station-day"""
+        if self.raw_format == 'parquet':
+            return _read_raw_parquet_file(self.output().path)
+        with self.output().open('r') as f:
+            content = f.read()
+        return digitraffic.parse_tms_station_raw_data(self.station['id'], self.date, content)
 
     def run(self):
-        content = digitraffic.fetch_tms_station_raw_data('01', self.station['id'], self.date)
-        with self.output().open('w') as out:
-            out.write(content)
+        self.download()
 
     @classmethod
     def bulk_complete(cls, parameter_tuples):
@@ -82,17 +191,94 @@ class DigitrafficVehicleCountRaw(luigi.Task):
         return completed
 
 
+class DigitrafficVehicleCountRawBulk(luigi.Task):
+    """Download raw LAM files for many stations and days concurrently.
+
+    The files end up in the same place as with DigitrafficVehicleCountRaw,
+    so the per-day tasks will find them already complete.
+    """
+    station_file = luigi.Parameter()
+    date_interval = luigi.DateIntervalParameter()
+    workers = luigi.IntParameter(default=8)
+
+    def get_raw_tasks(self):
+        stations = load_station_file(self.station_file)
+        return [
+            DigitrafficVehicleCountRaw(station_name=station, date=date)
+            for date in self.date_interval.dates() for station in stations
+        ]
+
+    def complete(self):
+        return all(task.complete() for task in self.get_raw_tasks())
+
+    def run(self):
+        tasks = [task for task in self.get_raw_tasks() if not task.complete()]
+        session = get_http_session(pool_size=self.workers)
+        meter = ThroughputMeter(total=len(tasks), tag='LAM download')
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(task.download, session): task for task in tasks}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    logger.error('Download of %s on %s failed: %s' % (task.station_name, task.date, e))
+                    failed.append(task)
+                    rows = 0
+                meter.update(rows)
+                self.set_status_message(meter.format())
+        logger.info(meter.format())
+        if failed:
+            raise Exception('%d of %d downloads failed' % (len(failed), len(tasks)))
+
+
+class DigitrafficMigrateRawToParquet(luigi.Task):
+    """Convert the existing raw CSV tree into the Parquet store"""
+    def complete(self):
+        return False
+
+    def run(self):
+        csv_root = os.path.join(settings.DATA_DIR, 'digitraffic/lam')
+        converted = 0
+        for dir_path, _, file_names in os.walk(csv_root):
+            for file_name in sorted(file_names):
+                if not file_name.endswith('.csv'):
+                    continue
+                station_name = file_name[:-len('.csv')]
+                year, month, day = [int(x) for x in os.path.relpath(dir_path, csv_root).split(os.sep)]
+                date = datetime(year, month, day).date()
+                target = luigi.LocalTarget(get_raw_data_path(station_name, date, 'parquet'))
+                if target.exists():
+                    continue
+                station = get_station_by_name(station_name)
+                with open(os.path.join(dir_path, file_name), 'r') as f:
+                    df = digitraffic.parse_tms_station_raw_data(station['id'], date, f.read())
+                write_raw_parquet(target, df)
+                converted += 1
+                self.set_status_message('%d files converted' % converted)
+        logger.info('Converted %d raw CSV files to Parquet' % converted)
+
+
+class DigitrafficMaterializeAggregates(luigi.Task):
+    """Materialize the vehicle count aggregates for the existing history"""
+    def complete(self):
+        return False
+
+    def run(self):
+        now = datetime.now(digitraffic.LOCAL_TZ)
+        DigitrafficTarget(settings.POSTGRESQL_DSN, start_time=now, end_time=now).materialize_history()
+
+
 class DigitrafficTMSStations(luigi.Task):
     def output(self):
-        path = 'digitraffic/lam_stations.json'
-        return luigi.LocalTarget(os.path.join(settings.DATA_DIR, path))
+        return luigi.LocalTarget(os.path.join(settings.DATA_DIR, STATION_CACHE_PATH))
+
+    def complete(self):
+        return self.output().exists() and not get_station_registry().is_stale()
 
     def run(self):
-        stations = digitraffic.get_tms_stations()
-        muni_id = int(settings.MUNICIPALITY_ID)
-        muni_stations = list(filter(lambda x: x['municipality_code'] and int(x['municipality_code']) == muni_id, stations))
-        with self.output().open('w') as out_file:
-            json.dump(muni_stations, out_file, indent=4)
+        get_station_registry().refresh()
 
 
 class DigitrafficVehicleCountDaily(luigi.Task):
@@ -101,65 +287,31 @@ class DigitrafficVehicleCountDaily(luigi.Task):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        start_time = datetime.combine(self.date, datetime.min.time())
-        end_time = datetime.combine(self.date, datetime.max.time())
-        local_tz = digitraffic.LOCAL_TZ
-        self.start_time = local_tz.localize(start_time)
-        self.end_time = local_tz.localize(end_time)
-
         self.station = get_station_by_name(self.station_name)
 
     def requires(self):
         return [DigitrafficVehicleCountRaw(self.station_name, self.date)]
 
     def _get_location_names(self):
-        station = self.station
-        directions = [station['direction%d_municipality' % i] for i in (1, 2)]
-        locations = ['%s_(%s)' % (station['name'], d) for d in directions]
-        return locations
+        return get_station_location_names(self.station)
 
     def output(self):
-        return DigitrafficTarget(
-            settings.POSTGRESQL_DSN, start_time=self.start_time, end_time=self.end_time,
-            locations=self._get_location_names()
-        )
+        return get_daily_target(self.station, self.date)
 
     def run(self):
-        with self.input()[0].open('r') as f:
-            content = f.read()
-            df = digitraffic.parse_tms_station_raw_data(self.station['id'], self.date, content)
-
-        # Group in buckets of one minute, columns as counts by vehicle type
-        df = df.groupby([pd.Grouper(freq='60s', sort=True), 'direction', 'vehicle_class']).size()\
-            .unstack('vehicle_class', fill_value=0)
-
-        # Fill in gaps in time index
-        dir_groups = df.groupby('direction')
-        dir_dfs = []
-        for dir_name, dir_df in dir_groups:
-            dir_df = dir_df.reset_index('direction').drop(columns='direction').resample('1min').asfreq(fill_value=0)
-            dir_df['direction'] = dir_name
-            dir_dfs.append(dir_df)
-
-        df = pd.concat(dir_dfs).reset_index().set_index(['time', 'direction'])
-
-        # Set directions (1, 2) to more descriptive names
-        assert list(df.index.levels[1]) == [1, 2]
-        df.index.set_levels(levels=self._get_location_names(), level='direction', inplace=True)
-
-        df = df.reset_index('direction').rename(columns=dict(direction='station_direction'))
+        df = self.requires()[0].read()
+        df = digitraffic.count_vehicles_per_minute(df, self.date, self._get_location_names())
 
         target = self.output()
         target.write(df)
 
     @classmethod
     def bulk_complete(cls, parameter_tuples):
-        completed = []
-        for date in parameter_tuples:
-            task = cls(date=date)
-            if task.complete():
-                completed.append(date)
-        return completed
+        # RangeDaily passes a one-shot iterator
+        parameter_tuples = list(parameter_tuples)
+        tasks = [cls(date=date) for date in parameter_tuples]
+        completed = find_complete_targets([task.output() for task in tasks])
+        return [date for date, is_complete in zip(parameter_tuples, completed) if is_complete]
 
 
 class DigitrafficVehicleCountAllSelected(luigi.Task):
@@ -167,25 +319,105 @@ class DigitrafficVehicleCountAllSelected(luigi.Task):
     date = luigi.DateParameter()
 
     def requires(self):
-        tasks = []
-        with open(self.station_file, 'r') as f:
-            for line in f.readlines():
-                station = line.strip()
-                get_station_by_name(station)
-                tasks.append(DigitrafficVehicleCountDaily(station_name=station, date=self.date))
-        return tasks
+        stations = load_station_file(self.station_file)
+        return [DigitrafficVehicleCountDaily(station_name=station, date=self.date) for station in stations]
 
     def run(self):
         pass
 
     def complete(self):
-        return all([task.complete() for task in self.requires()])
+        return all(find_complete_targets([task.output() for task in self.requires()]))
 
     @classmethod
     def bulk_complete(cls, parameter_tuples):
-        completed = []
-        for date in parameter_tuples:
-            task = cls(date=date)
-            if task.complete():
-                completed.append(date)
-        return completed
+        # Check the daily tasks of every station and date in one query
+        daily_tasks = {date: cls(date=date).requires() for date in parameter_tuples}
+        all_tasks = [task for tasks in daily_tasks.values() for task in tasks]
+        completed = dict(zip(all_tasks, find_complete_targets([task.output() for task in all_tasks])))
+        return [date for date, tasks in daily_tasks.items() if all(completed[task] for task in tasks)]
+
+
+class DigitrafficVehicleCountRange(luigi.Task):
+    """Count vehicles for a set of stations over a date range in one worker.
+
+    Avoids scheduling one Luigi task per station-day: each day is
+    downloaded (concurrently over the stations), parsed and aggregated,
+    and the results are written in large bulk batches. Station-days that
+    have been written are recorded in a checkpoint file, so an interrupted
+    run continues where it left off.
+    """
+    station_file = luigi.Parameter()
+    date_interval = luigi.DateIntervalParameter()
+    batch_rows = luigi.IntParameter(default=500000)
+    workers = luigi.IntParameter(default=8)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stations = [get_station_by_name(name) for name in load_station_file(self.station_file)]
+
+    def get_targets(self):
+        return {
+            (station['name'], date): get_daily_target(station, date)
+            for date in self.date_interval.dates() for station in self.stations
+        }
+
+    def complete(self):
+        return all(find_complete_targets(list(self.get_targets().values())))
+
+    def run(self):
+        checkpoint = Checkpoint(os.path.join(
+            settings.DATA_DIR, 'digitraffic/checkpoints/%s.checkpoint' % self.task_id
+        ))
+        targets = self.get_targets()
+        keys = [key for key in targets.keys() if '%s:%s' % key not in checkpoint]
+        completed = find_complete_targets([targets[key] for key in keys])
+        todo = [key for key, is_complete in zip(keys, completed) if not is_complete]
+
+        session = get_http_session(pool_size=self.workers)
+        meter = ThroughputMeter(total=len(todo), tag='LAM range')
+        pending = []
+        pending_keys = []
+        failed = []
+
+        def flush():
+            if not pending:
+                return
+            # Any of the daily targets can write rows for the whole batch
+            targets[pending_keys[0]].write(pd.concat(pending), bulk=True)
+            for key in pending_keys:
+                checkpoint.mark_done('%s:%s' % key)
+            pending.clear()
+            pending_keys.clear()
+
+        def download(task):
+            if not task.complete():
+                task.download(session)
+
+        by_date = {}
+        for station_name, date in todo:
+            by_date.setdefault(date, []).append(station_name)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for date, station_names in sorted(by_date.items()):
+                raw_tasks = [DigitrafficVehicleCountRaw(station_name=name, date=date) for name in station_names]
+                futures = [executor.submit(download, task) for task in raw_tasks]
+                for task, future in zip(raw_tasks, futures):
+                    try:
+                        future.result()
+                        df = task.read()
+                        df = digitraffic.count_vehicles_per_minute(df, date, get_station_location_names(task.station))
+                    except Exception as e:
+                        logger.error('Skipping %s on %s: %s' % (task.station_name, date, e))
+                        failed.append((task.station_name, date))
+                        meter.update(0)
+                        continue
+                    pending.append(df)
+                    pending_keys.append((task.station_name, date))
+                    meter.update(len(df))
+                    if sum(len(x) for x in pending) >= self.batch_rows:
+                        flush()
+                self.set_status_message(meter.format())
+                logger.info(meter.format())
+        flush()
+        if failed:
+            raise Exception('%d of %d station days failed' % (len(failed), len(todo)))
@@ -1,13 +1,22 @@
+import os
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta, datetime, date
 
 import luigi
 import pandas as pd
+import pytz
 
 from data_import import fingrid
+from data_import.exceptions import NoRowsReturned
+from utils.checkpoint import Checkpoint
+from utils.data_import import coalesce_intervals
+from utils.http import get_http_session
+from utils.perf import ThroughputMeter
+from utils.rate_limit import TokenBucket
 import settings
 
-from .targets.timescaledb import TimescaleDBTarget
+from .targets.timescaledb import TimescaleDBTarget, find_complete_targets
 from .targets.quilt import QuiltDataframeTarget
 
 
@@ -24,7 +33,17 @@ if not settings.NUUKA_API_KEY:
 
 
 class FingridDBTarget(TimescaleDBTarget):
-    pass
+    continuous_aggregates = {'hourly': '1 hour', 'daily': '1 day'}
+    compress_after = '90 days'
+
+
+def get_fingrid_target(measurement_name, start_time, end_time):
+    m = fingrid.get_measurement_meta_data(measurement_name)
+    target = FingridDBTarget(settings.POSTGRESQL_DSN, start_time=start_time, end_time=end_time)
+    target.measurement_name = 'fingrid_%s' % measurement_name
+    target.value_columns = [(m['quantity'], float)]
+    target.interval = m['interval']
+    return target
 
 
 class FingridTask:
@@ -37,13 +56,9 @@ class FingridTask:
         self.end_time -= timedelta(seconds=1)
 
     def output(self):
-        target = FingridDBTarget(settings.POSTGRESQL_DSN, start_time=self.start_time, end_time=self.end_time)
-        target.measurement_name = 'fingrid_%s' % self.measurement_name
-        target.value_columns = [(self.meta_data['quantity'], float)]
-        target.interval = self.meta_data['interval']
-        return target
+        return get_fingrid_target(self.measurement_name, self.start_time, self.end_time)
 
-    def complete(self):
+    def is_past_end_date(self):
         local_tz = fingrid.LOCAL_TZ
 
         end_date = self.meta_data.get('end_date')
@@ -51,6 +66,11 @@ class FingridTask:
             last_time = local_tz.localize(datetime.combine(end_date, datetime.min.time()))
             if self.end_time > last_time:
                 return True
+        return False
+
+    def complete(self):
+        if self.is_past_end_date():
+            return True
 
         return self.output().exists()
 
@@ -136,12 +156,209 @@ class FingridMonthlyAllMeasurementsTask(luigi.Task):
         return tasks
 
     def complete(self):
-        return all([task.complete() for task in self.requires()])
+        tasks = [task for task in self.requires() if not task.is_past_end_date()]
+        return all(find_complete_targets([task.output() for task in tasks]))
 
     def run(self):
         pass
 
 
+def backfill_measurements(measurement_names=None, end_time=None, workers=4, requests_per_minute=None,
+                          checkpoint_path=None):
+    """Backfill the full history of Fingrid measurements into TimescaleDB.
+
+    The data range of every measurement is split into API-sized windows
+    which are fetched by a pool of worker threads sharing one rate limiter
+    and HTTP session. Each window is written to the database as soon as it
+    arrives and then recorded in a checkpoint file, so an interrupted
+    backfill continues where it left off. Failed windows are retried on the
+    next run; an exception is raised after the rest have been processed.
+    """
+    fingrid.set_api_key(settings.FINGRID_API_KEY)
+
+    if measurement_names is None:
+        measurement_names = list(fingrid.MEASUREMENTS.keys())
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join(settings.DATA_DIR, 'fingrid/backfill.checkpoint')
+    checkpoint = Checkpoint(checkpoint_path)
+    rate_limiter = TokenBucket.per_minute(requests_per_minute or fingrid.API_REQUESTS_PER_MINUTE)
+    session = get_http_session(pool_size=workers)
+
+    jobs = []
+    for name in measurement_names:
+        start_time, last_time = fingrid.get_measurement_time_range(name, end_time)
+        for window_start, window_end in fingrid.split_time_range(name, start_time, last_time):
+            key = '%s:%s' % (name, window_start.astimezone(pytz.utc).isoformat())
+            if key in checkpoint:
+                continue
+            # The last window is still filling up, so it is never checkpointed
+            is_final = window_end < last_time
+            jobs.append((name, window_start, window_end, key, is_final))
+
+    meter = ThroughputMeter(total=len(jobs), tag='fingrid backfill')
+    logger.info('Backfilling %d windows (%d already done)' % (len(jobs), len(checkpoint)))
+
+    def process_window(name, window_start, window_end, key, is_final):
+        rate_limiter.acquire()
+        try:
+            df = fingrid.get_measurements(
+                name, window_start, window_end - timedelta(seconds=1), session=session
+            )
+        except NoRowsReturned:
+            df = None
+        if df is not None:
+            get_fingrid_target(name, window_start, window_end).write(df)
+        if is_final:
+            checkpoint.mark_done(key)
+        return len(df) if df is not None else 0
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_window, *job): job for job in jobs}
+        for future in as_completed(futures):
+            name, window_start = futures[future][0:2]
+            try:
+                rows = future.result()
+            except Exception:
+                logger.exception('Backfill of %s from %s failed' % (name, window_start.isoformat()))
+                failed.append(futures[future])
+                meter.update(0)
+                continue
+            meter.update(rows)
+            logger.info(meter.format())
+
+    if failed:
+        raise Exception('%d of %d backfill windows failed' % (len(failed), len(jobs)))
+
+    return meter
+
+
+class FingridBackfillTask(luigi.Task):
+    measurement_names = luigi.ListParameter(default=())
+    workers = luigi.IntParameter(default=4)
+
+    def complete(self):
+        return False
+
+    def run(self):
+        meter = backfill_measurements(list(self.measurement_names) or None, workers=self.workers)
+        self.set_status_message(meter.format())
+
+
+# How far back the regular sync looks for holes in the data
+SYNC_LOOKBACK = timedelta(days=30)
+# Holes closer to each other than this many samples are fetched in one request
+SYNC_MERGE_SAMPLES = 100
+# Holes the API returned no rows for are not asked for again once they are
+# older than this, since the data is not going to be published anymore
+SYNC_GIVE_UP_AFTER = timedelta(days=1)
+SYNC_EMPTY_CHECKPOINT_PATH = 'fingrid/sync_empty.checkpoint'
+
+
+def _get_gap_key(measurement_name, gap):
+    return '%s:%s:%s' % (measurement_name, gap[0].astimezone(pytz.utc).isoformat(), gap[1].astimezone(pytz.utc).isoformat())
+
+
+def sync_measurement(measurement_name, start_time=None, end_time=None, session=None, rate_limiter=None,
+                     empty_checkpoint=None):
+    """Fetch only the samples that are missing from the measurement table.
+
+    The missing intervals are computed in SQL from the expected sample
+    interval, coalesced into as few API requests as possible and fetched.
+    Requests go through `rate_limiter`, which should be shared when
+    syncing several measurements. Holes the API has no data for are
+    recorded in `empty_checkpoint` and skipped on later runs.
+    Returns the number of rows written.
+    """
+    fingrid.set_api_key(settings.FINGRID_API_KEY)
+    if rate_limiter is None:
+        rate_limiter = TokenBucket.per_minute(fingrid.API_REQUESTS_PER_MINUTE)
+    if empty_checkpoint is None:
+        empty_checkpoint = Checkpoint(os.path.join(settings.DATA_DIR, SYNC_EMPTY_CHECKPOINT_PATH))
+
+    m = fingrid.get_measurement_meta_data(measurement_name)
+    data_start, data_end = fingrid.get_measurement_time_range(measurement_name, end_time)
+    if start_time is None:
+        start_time = max(data_start, data_end - SYNC_LOOKBACK)
+    if start_time >= data_end:
+        return 0
+
+    target = get_fingrid_target(measurement_name, start_time, data_end)
+    all_gaps = target.find_gaps()
+    gaps = [gap for gap in all_gaps if _get_gap_key(measurement_name, gap) not in empty_checkpoint]
+    interval = timedelta(seconds=m['interval'])
+    fetch_windows = coalesce_intervals(
+        gaps, interval, max_distance=interval * SYNC_MERGE_SAMPLES,
+        max_length=interval * fingrid.API_MAX_ROWS,
+    )
+    logger.info('%s: %d gaps (%d known to be empty), %d requests' % (
+        measurement_name, len(all_gaps), len(all_gaps) - len(gaps), len(fetch_windows)
+    ))
+
+    give_up_before = datetime.now(pytz.utc) - SYNC_GIVE_UP_AFTER
+    rows = 0
+    for gap_start, gap_end in fetch_windows:
+        rate_limiter.acquire()
+        try:
+            df = fingrid.get_measurements(measurement_name, gap_start, gap_end, session=session)
+        except NoRowsReturned:
+            for gap in gaps:
+                if gap[0] >= gap_start and gap[1] <= gap_end and gap[1] < give_up_before:
+                    empty_checkpoint.mark_done(_get_gap_key(measurement_name, gap))
+            continue
+        target.write(df)
+        rows += len(df)
+    return rows
+
+
+class FingridSyncTask(luigi.Task):
+    measurement_name = luigi.ChoiceParameter(choices=fingrid.MEASUREMENTS.keys())
+    full = luigi.BoolParameter(description='Look for gaps in the whole history instead of the last days')
+
+    def complete(self):
+        return False
+
+    def run(self):
+        start_time = None
+        if self.full:
+            start_time, _ = fingrid.get_measurement_time_range(self.measurement_name)
+        rows = sync_measurement(self.measurement_name, start_time=start_time)
+        self.set_status_message('%d rows written' % rows)
+
+
+class FingridSyncAllTask(luigi.Task):
+    def complete(self):
+        return False
+
+    def run(self):
+        today = date.today()
+        session = get_http_session(pool_size=1)
+        # The API quota is shared by all the measurements
+        rate_limiter = TokenBucket.per_minute(fingrid.API_REQUESTS_PER_MINUTE)
+        empty_checkpoint = Checkpoint(os.path.join(settings.DATA_DIR, SYNC_EMPTY_CHECKPOINT_PATH))
+        for measurement_name, m in fingrid.MEASUREMENTS.items():
+            end_date = m.get('end_date')
+            if end_date and today > end_date:
+                continue
+            sync_measurement(
+                measurement_name, session=session, rate_limiter=rate_limiter, empty_checkpoint=empty_checkpoint
+            )
+
+
+class FingridMaterializeAggregates(luigi.Task):
+    """Materialize the aggregates of Fingrid measurements for the existing history"""
+    measurement_names = luigi.ListParameter(default=())
+
+    def complete(self):
+        return False
+
+    def run(self):
+        for measurement_name in list(self.measurement_names) or fingrid.MEASUREMENTS.keys():
+            start_time, end_time = fingrid.get_measurement_time_range(measurement_name)
+            get_fingrid_target(measurement_name, start_time, end_time).materialize_history()
+            self.set_status_message('%s materialized' % measurement_name)
+
+
 class FingridUpdateQuiltTask(luigi.Task):
     measurement_type = luigi.ChoiceParameter(choices=['power', 'temperature', 'price'])
     no_push = luigi.BoolParameter()
@@ -152,7 +369,7 @@ class FingridUpdateQuiltTask(luigi.Task):
         super().__init__(*args, **kwargs)
         last_day = date.today().replace(day=1) - timedelta(days=1)
         self.last_month = last_day.replace(day=1)
-        self.end_time = datetime.combine(last_day, datetime.max.time())
+        self.end_time = fingrid.LOCAL_TZ.localize(datetime.combine(last_day, datetime.max.time()))
 
         self.measurements = [(n, m) for n, m in fingrid.MEASUREMENTS.items() if self.include_measurement(m)]
 
@@ -176,8 +393,8 @@ class FingridUpdateQuiltTask(luigi.Task):
     def complete(self):
         return False
 
-    def process_df(self, df):
-        return df
+    def read_df(self, task):
+        return task.output().read(before=self.end_time)
 
     def run(self):
         target = self.output()
@@ -185,8 +402,7 @@ class FingridUpdateQuiltTask(luigi.Task):
         for (measurement_name, m), task in zip(self.measurements, self.requires()):
             self.set_status_message("Reading %s" % task.measurement_name)
             logger.info('Reading %s' % task.measurement_name)
-            df = task.output().read(before=self.end_time)
-            df = self.process_df(df)
+            df = self.read_df(task)
             assert len(df.columns) == 1
             logger.info('Read %d rows' % len(df))
             col_name = df.columns[0]
@@ -209,5 +425,6 @@ class FingridUpdateQuiltTask(luigi.Task):
 class FingridUpdateQuiltHourlyTask(FingridUpdateQuiltTask):
     quilt_package_name = 'fingrid_hourly'
 
-    def process_df(self, df):
-        return df.groupby(pd.Grouper(freq='1h')).mean()
+    def read_df(self, task):
+        # Let TimescaleDB do the downsampling so only hourly rows are transferred
+        return task.output().read_aggregated('1h', agg='mean', before=self.end_time).sort_index()
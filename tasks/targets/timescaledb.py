@@ -1,6 +1,11 @@
+import io
+import math
 import os
+import time
+import logging
+import threading
 import collections
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 import pytz
 import luigi
@@ -10,9 +15,15 @@ import pandas as pd
 from sqlalchemy.dialects.postgresql import insert
 
 
+logger = logging.getLogger(__name__)
+
+
 class TimescaleDBTarget(luigi.Target):
     _engine_dict = {}  # dict of sqlalchemy engine instances
     Connection = collections.namedtuple("Connection", "engine pid")
+    # sa.Table instances whose DDL has been verified, keyed by (dsn, pid, table name)
+    _table_registry = {}
+    _table_registry_lock = threading.Lock()
 
     # Override these in a subclass
     measurement_name = None
@@ -21,6 +32,28 @@ class TimescaleDBTarget(luigi.Target):
     location_column = None  # optional
     location_type = str
 
+    # Continuous aggregates kept up to date by TimescaleDB, as a dict of
+    # {view name suffix: bucket}, e.g. {'hourly': '1 hour'}. Each view stores
+    # the sum, min, max and count of every value column per bucket.
+    continuous_aggregates = {}
+    # Compress chunks older than this (PostgreSQL interval), segmented by the
+    # location column. Compressed chunks are decompressed before writing
+    # into them, since upserts into compressed chunks need TimescaleDB 2.11;
+    # the compression policy compresses them again later.
+    compress_after = None
+    # Drop raw rows older than this; the continuous aggregates are kept.
+    # Must be longer than a few buckets of the coarsest aggregate.
+    drop_raw_after = None
+    # Record the time range of every write in a "<measurement>_writes"
+    # table, so that data derived from this measurement can be recomputed
+    # for the changed ranges only. Writes stay unprocessed until the
+    # consumer marks them processed.
+    log_writes = False
+
+    # Frames with at least this many rows are written using COPY
+    bulk_write_threshold = 5000
+    bulk_write_chunk_size = 100000
+
     def __init__(self, connection_dsn, start_time, end_time, locations=None):
         self.connection_dsn = connection_dsn
         self.start_time = start_time.astimezone(pytz.utc)
@@ -59,6 +92,25 @@ class TimescaleDBTarget(luigi.Target):
         raise Exception("Invalid type: %s" % klass)
 
     def get_table(self):
+        """Return the sa.Table for the measurement, creating it if needed.
+
+        The table is looked up and its DDL run at most once per process and
+        DSN; later calls are served from a registry without touching the
+        database.
+        """
+        key = (self.connection_dsn, os.getpid(), self.measurement_name)
+        table = TimescaleDBTarget._table_registry.get(key)
+        if table is not None:
+            return table
+
+        with TimescaleDBTarget._table_registry_lock:
+            table = TimescaleDBTarget._table_registry.get(key)
+            if table is None:
+                table = self._create_table()
+                TimescaleDBTarget._table_registry[key] = table
+        return table
+
+    def _create_table(self):
         Column = sa.Column
         table_name = self.measurement_name
 
@@ -86,30 +138,231 @@ class TimescaleDBTarget(luigi.Target):
                 if self.location_column:
                     con.execute("CREATE INDEX ON %s (%s, time DESC)" % (table_name, self.location_column))
                 con.execute("SELECT set_chunk_time_interval('%s', interval '1 month')" % table_name).fetchall()
+            self._ensure_policies(con)
+            if self.log_writes:
+                con.execute(
+                    'CREATE TABLE IF NOT EXISTS "%s_writes" (id bigserial PRIMARY KEY, '
+                    'written_at timestamptz NOT NULL DEFAULT now(), '
+                    'start_time timestamptz NOT NULL, end_time timestamptz NOT NULL, '
+                    'processed boolean NOT NULL DEFAULT false)' % table_name
+                )
+                con.execute(
+                    'CREATE INDEX IF NOT EXISTS "%s_writes_unprocessed_idx" ON "%s_writes" (id) '
+                    'WHERE NOT processed' % (table_name, table_name)
+                )
 
         return table
 
+    def _get_continuous_aggregates(self):
+        """Return (view name, bucket timedelta) pairs, finest bucket first"""
+        out = []
+        for suffix, bucket in self.continuous_aggregates.items():
+            bucket = pd.to_timedelta(bucket).to_pytimedelta()
+            # Aggregating to the native sample interval would not save anything
+            if bucket <= timedelta(seconds=self.interval):
+                continue
+            out.append(('%s_%s' % (self.measurement_name, suffix), bucket))
+        return sorted(out, key=lambda x: x[1])
+
+    def _ensure_policies(self, con):
+        table_name = self.measurement_name
+
+        if self.compress_after:
+            row = con.execute(sa.text(
+                "SELECT compression_enabled FROM timescaledb_information.hypertables WHERE hypertable_name = :name"
+            ), name=table_name).fetchone()
+            if row is not None and not row[0]:
+                opts = "timescaledb.compress, timescaledb.compress_orderby = 'time DESC'"
+                if self.location_column:
+                    opts += ", timescaledb.compress_segmentby = '%s'" % self.location_column
+                con.execute('ALTER TABLE "%s" SET (%s)' % (table_name, opts))
+            con.execute(sa.text(
+                "SELECT add_compression_policy(CAST(:name AS regclass), CAST(:after AS interval), if_not_exists => true)"
+            ), name=table_name, after=self.compress_after)
+
+        for view_name, bucket in self._get_continuous_aggregates():
+            select_cols = ["time_bucket(INTERVAL '%d seconds', time) AS time" % bucket.total_seconds()]
+            group_cols = ['1']
+            if self.location_column:
+                select_cols.append('"%s"' % self.location_column)
+                group_cols.append('2')
+            for col_name, _ in self.value_columns:
+                for func in ('sum', 'min', 'max', 'count'):
+                    select_cols.append('%s("%s") AS "%s_%s"' % (func, col_name, col_name, func))
+            con.execute(
+                'CREATE MATERIALIZED VIEW IF NOT EXISTS "%s" WITH (timescaledb.continuous) AS '
+                'SELECT %s FROM "%s" GROUP BY %s WITH NO DATA' % (
+                    view_name, ', '.join(select_cols), table_name, ', '.join(group_cols)
+                )
+            )
+            con.execute(sa.text(
+                "SELECT add_continuous_aggregate_policy(CAST(:name AS regclass), "
+                "start_offset => :start_offset, end_offset => :end_offset, "
+                "schedule_interval => :schedule_interval, if_not_exists => true)"
+            ), name=view_name, start_offset=4 * bucket, end_offset=bucket, schedule_interval=bucket)
+
+        if self.drop_raw_after:
+            con.execute(sa.text(
+                "SELECT add_retention_policy(CAST(:name AS regclass), CAST(:after AS interval), if_not_exists => true)"
+            ), name=table_name, after=self.drop_raw_after)
+
+    def _get_materialized_range(self, con, view_name):
+        """Return the first and last materialized bucket of a continuous aggregate"""
+        row = con.execute(sa.text(
+            "SELECT materialization_hypertable_schema, materialization_hypertable_name "
+            "FROM timescaledb_information.continuous_aggregates WHERE view_name = :name"
+        ), name=view_name).fetchone()
+        if row is None:
+            return None, None
+        return con.execute('SELECT min(time), max(time) FROM "%s"."%s"' % tuple(row)).fetchone()
+
+    def materialize_history(self):
+        """Materialize the continuous aggregates for data older than the views.
+
+        The views are created empty and the refresh policies only cover the
+        latest buckets, so data that was in the table already when a view was
+        created has to be refreshed once. This can take hours on a large
+        table, so it is run explicitly (see the *MaterializeAggregates tasks)
+        instead of when the table is first used; until then, queries are
+        answered from the raw table.
+        """
+        caggs = self._get_continuous_aggregates()
+        if not caggs:
+            return
+        self.get_table()
+        table_name = self.measurement_name
+        epoch = pd.Timestamp(0, tz='UTC')
+        with self.engine.connect() as con:
+            first, last = con.execute('SELECT min(time), max(time) FROM "%s"' % table_name).fetchone()
+            if first is None:
+                return
+            first = pd.Timestamp(first).tz_convert('UTC')
+            stale = False
+            for view_name, bucket in caggs:
+                first_bucket = epoch + ((first - epoch) // bucket) * bucket
+                view_first, _ = self._get_materialized_range(con, view_name)
+                if view_first is None or pd.Timestamp(view_first) > first_bucket:
+                    stale = True
+        if stale:
+            logger.info('%s: materializing continuous aggregates from %s to %s' % (table_name, first, last))
+            self.refresh_aggregates(first, last)
+
+    def refresh_aggregates(self, start_time, end_time):
+        """Materialize the continuous aggregates for a time range.
+
+        The refresh policies only cover recent buckets, so this needs to be
+        called after writing older data (e.g. in backfills).
+        """
+        caggs = self._get_continuous_aggregates()
+        if not caggs:
+            return
+        epoch = pd.Timestamp(0, tz='UTC')
+        start_time = pd.Timestamp(start_time).tz_convert('UTC')
+        end_time = pd.Timestamp(end_time).tz_convert('UTC')
+        # refresh_continuous_aggregate() cannot be run inside a transaction
+        with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as con:
+            for view_name, bucket in caggs:
+                # Only buckets completely inside the window are refreshed
+                window_start = epoch + ((start_time - epoch) // bucket) * bucket
+                window_end = epoch + ((end_time - epoch) // bucket + 1) * bucket
+                con.execute(sa.text(
+                    "CALL refresh_continuous_aggregate(CAST(:name AS regclass), "
+                    "CAST(:start AS timestamptz), CAST(:end AS timestamptz))"
+                ), name=view_name, start=window_start.to_pydatetime(), end=window_end.to_pydatetime())
+
+    def _has_enough_rows(self, row_count):
+        nr_locations = len(self.locations) if self.locations else 1
+        time_slots = int((self.end_time - self.start_time) / timedelta(seconds=self.interval))
+        time_slots *= nr_locations
+        # Allow 1% of the samples to go missing (due to misc. weirdness)
+        return row_count >= int(0.99 * time_slots)
+
     def exists(self):
         table = self.get_table()
 
         conditions = [table.c.time >= self.start_time, table.c.time <= self.end_time]
         if self.locations:
             conditions.append(getattr(table.c, self.location_column).in_(self.locations))
-            nr_locations = len(self.locations)
-        else:
-            nr_locations = 1
         sql = sa.select([sa.func.count(table.c.time)])\
             .where(sa.and_(*conditions))
 
         with self.engine.connect() as con:
             row_count = con.execute(sql).fetchone()[0]
 
-        time_slots = int((self.end_time - self.start_time) / timedelta(seconds=self.interval))
-        time_slots *= nr_locations
-        # Allow 1% of the samples to go missing (due to misc. weirdness)
-        if row_count < int(0.99 * time_slots):
-            return False
-        return True
+        return self._has_enough_rows(row_count)
+
+    def find_gaps(self, start_time=None, end_time=None):
+        """Return the time intervals with missing rows.
+
+        Uses the expected `interval` between samples to detect holes in the
+        series inside [start_time, end_time]. Returns a list of
+        (gap_start, gap_end) tuples with the first and last missing sample
+        times, or, if the target has a location column, a dict of such lists
+        keyed by location.
+        """
+        table = self.get_table()
+        start_time = (start_time or self.start_time).astimezone(pytz.utc)
+        end_time = (end_time or self.end_time).astimezone(pytz.utc)
+        step = timedelta(seconds=self.interval)
+
+        # Only the samples on the interval grid inside the range are expected
+        epoch = datetime(1970, 1, 1, tzinfo=pytz.utc)
+        start_time = epoch + step * math.ceil((start_time - epoch) / step)
+        end_time = epoch + step * math.floor((end_time - epoch) / step)
+        if end_time < start_time:
+            return [] if not self.location_column else {loc: [] for loc in self.locations}
+
+        if self.location_column:
+            assert self.locations, 'locations must be given to find gaps'
+            loc_col = self.location_column
+            loc_select = 'CAST(%s AS text) AS loc, ' % loc_col
+            loc_filter = 'AND CAST(%s AS text) = ANY(:locations)' % loc_col
+            sentinels = (
+                'SELECT loc, ts FROM unnest(CAST(:locations AS text[])) AS loc, '
+                '(VALUES (CAST(:start_time AS timestamptz) - CAST(:step AS interval)), '
+                '(CAST(:end_time AS timestamptz) + CAST(:step AS interval))) AS s(ts)'
+            )
+            partition = 'PARTITION BY loc '
+        else:
+            loc_select = 'NULL AS loc, '
+            loc_filter = ''
+            sentinels = (
+                'SELECT NULL, CAST(:start_time AS timestamptz) - CAST(:step AS interval) '
+                'UNION ALL SELECT NULL, CAST(:end_time AS timestamptz) + CAST(:step AS interval)'
+            )
+            partition = ''
+
+        sql = """
+            SELECT loc, prev_ts + CAST(:step AS interval) AS gap_start, ts - CAST(:step AS interval) AS gap_end
+            FROM (
+                SELECT loc, ts, lag(ts) OVER (%(partition)sORDER BY ts) AS prev_ts
+                FROM (
+                    SELECT %(loc_select)stime AS ts FROM %(table)s
+                    WHERE time >= :start_time AND time <= :end_time %(loc_filter)s
+                    UNION ALL %(sentinels)s
+                ) AS samples
+            ) AS deltas
+            WHERE ts - prev_ts > CAST(:step AS interval)
+                AND ts - CAST(:step AS interval) >= prev_ts + CAST(:step AS interval)
+            ORDER BY loc, gap_start
+        """ % dict(
+            partition=partition, loc_select=loc_select, table=table.name, loc_filter=loc_filter,
+            sentinels=sentinels,
+        )
+        params = dict(start_time=start_time, end_time=end_time, step=step)
+        if self.location_column:
+            params['locations'] = [str(x) for x in self.locations]
+
+        with self.engine.connect() as con:
+            rows = con.execute(sa.text(sql), **params).fetchall()
+
+        if not self.location_column:
+            return [(r.gap_start, r.gap_end) for r in rows]
+
+        gaps = {loc: [] for loc in self.locations}
+        for r in rows:
+            gaps[self.location_type(r.loc)].append((r.gap_start, r.gap_end))
+        return gaps
 
     def get_latest_row(self, before=None):
         table = self.get_table()
@@ -118,9 +371,17 @@ class TimescaleDBTarget(luigi.Target):
         if before:
             query = query.where(table.c.time < before)
         res = query.order_by(sa.desc(table.c.time)).limit(1).execute()
-        return dict(res.fetchone())
+        row = res.fetchone()
+        return dict(row) if row is not None else None
 
-    def write(self, df):
+    def write(self, df, bulk=None):
+        """Upsert the rows of `df` into the table.
+
+        If existing rows conflict, their values are replaced with the
+        incoming data. Large frames are streamed with COPY into a staging
+        table and merged with one INSERT ... SELECT; set `bulk` to force
+        either path.
+        """
         df = df.copy()
         df.index = df.index.tz_convert('UTC')
         df.index.name = 'time'
@@ -131,33 +392,476 @@ class TimescaleDBTarget(luigi.Target):
             location_column_set.add(self.location_column)
         assert set(df.columns) == value_column_set | location_column_set
 
-        rows = df.reset_index().to_dict('records')
+        if bulk is None:
+            bulk = len(df) >= self.bulk_write_threshold
 
         table = self.get_table()
-        stmt = insert(table)
+        start = time.perf_counter()
+        if self.compress_after and len(df):
+            self._decompress_range(df.index.min(), df.index.max())
+        if bulk:
+            self._write_copy(df, table)
+        else:
+            self._write_upsert(df, table)
+        elapsed = time.perf_counter() - start
+        logger.info('Wrote %d rows to %s in %.1f s (%.0f rows/s)' % (
+            len(df), table.name, elapsed, len(df) / elapsed if elapsed > 0 else 0
+        ))
+        if len(df):
+            self.refresh_aggregates(df.index.min(), df.index.max())
+            # Logged only after the aggregates are up to date, so readers of
+            # the log never see stale buckets
+            if self.log_writes:
+                self._log_write(df.index.min(), df.index.max())
+
+    def _decompress_range(self, start_time, end_time):
+        """Decompress the chunks overlapping a time range"""
+        try:
+            compressed_before = pd.Timestamp.now(tz='UTC') - pd.to_timedelta(self.compress_after)
+            if start_time >= compressed_before:
+                # Recent data is never in a compressed chunk
+                return
+        except ValueError:
+            # Calendar intervals like '1 month' are always checked
+            pass
+        with self.engine.begin() as con:
+            chunks = con.execute(sa.text(
+                "SELECT format('%I.%I', chunk_schema, chunk_name) FROM timescaledb_information.chunks "
+                "WHERE hypertable_name = :name AND is_compressed AND range_end > :start AND range_start <= :end"
+            ), name=self.measurement_name, start=start_time.to_pydatetime(), end=end_time.to_pydatetime()).fetchall()
+            for chunk, in chunks:
+                logger.info('%s: decompressing chunk %s' % (self.measurement_name, chunk))
+                con.execute(sa.text(
+                    "SELECT decompress_chunk(CAST(:chunk AS regclass), if_compressed => true)"
+                ), chunk=chunk)
+
+    def _log_write(self, start_time, end_time):
+        with self.engine.begin() as con:
+            con.execute(sa.text(
+                'INSERT INTO "%s_writes" (start_time, end_time) VALUES (:start, :end)' % self.measurement_name
+            ), start=start_time.to_pydatetime(), end=end_time.to_pydatetime())
+
+    def get_unprocessed_writes(self):
+        """Return the writes not marked processed as (id, start time, end time) tuples, oldest first.
+
+        Requires `log_writes` to be set.
+        """
+        assert self.log_writes
+        self.get_table()
+        with self.engine.connect() as con:
+            rows = con.execute(
+                'SELECT id, start_time, end_time FROM "%s_writes" WHERE NOT processed ORDER BY id' % self.measurement_name
+            ).fetchall()
+        return [(row[0], pd.Timestamp(row[1]).tz_convert('UTC'), pd.Timestamp(row[2]).tz_convert('UTC')) for row in rows]
+
+    def mark_writes_processed(self, ids):
+        """Mark logged writes as processed so they are not returned again.
+
+        Writes are tracked by id instead of a high-water mark, because
+        concurrent writers can commit their log rows out of id order.
+        """
+        if not ids:
+            return
+        with self.engine.begin() as con:
+            con.execute(sa.text(
+                'UPDATE "%s_writes" SET processed = true WHERE id = ANY(:ids)' % self.measurement_name
+            ), ids=list(ids))
+
+    def get_time_range(self):
+        """Return the first and last timestamp in the table, or (None, None) if it is empty"""
+        self.get_table()
+        with self.engine.connect() as con:
+            first, last = con.execute('SELECT min(time), max(time) FROM "%s"' % self.measurement_name).fetchone()
+        if first is None:
+            return None, None
+        return pd.Timestamp(first).tz_convert('UTC'), pd.Timestamp(last).tz_convert('UTC')
+
+    def _get_key_columns(self):
         index_elements = ['time']
         if self.location_column:
             index_elements.append(self.location_column)
-        update_set = {col_name: getattr(stmt.excluded, col_name) for col_name in value_column_set}
-        # Do an UPSERT: If existing rows conflict, replace their values with
-        # incoming data.
+        return index_elements
+
+    def _write_upsert(self, df, table):
+        rows = df.reset_index().to_dict('records')
+
+        stmt = insert(table)
+        update_set = {col_name: getattr(stmt.excluded, col_name) for col_name, _ in self.value_columns}
         stmt = stmt.on_conflict_do_update(
-            index_elements=index_elements,
+            index_elements=self._get_key_columns(),
             set_=update_set,
         )
         with self.engine.begin() as con:
             con.execute(stmt, rows)
 
-    def read(self, before=None, after=None):
+    def _write_copy(self, df, table):
+        key_columns = self._get_key_columns()
+        value_columns = [x[0] for x in self.value_columns]
+        columns = key_columns + value_columns
+
+        df = df.reset_index()
+        # Within one INSERT a row can only be updated once, so resolve
+        # duplicates the same way consecutive upserts would: last one wins.
+        df = df.drop_duplicates(subset=key_columns, keep='last')
+
+        staging_name = '%s_staging' % table.name
+        col_str = ', '.join('"%s"' % c for c in columns)
+        update_str = ', '.join('"%s" = EXCLUDED."%s"' % (c, c) for c in value_columns)
+
+        raw_con = self.engine.raw_connection()
+        try:
+            cursor = raw_con.cursor()
+            cursor.execute(
+                'CREATE TEMPORARY TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS) ON COMMIT DROP' % (
+                    staging_name, table.name
+                )
+            )
+            copy_sql = 'COPY "%s" (%s) FROM STDIN WITH (FORMAT csv)' % (staging_name, col_str)
+            for offset in range(0, len(df), self.bulk_write_chunk_size):
+                chunk = df.iloc[offset:offset + self.bulk_write_chunk_size]
+                buf = io.StringIO()
+                chunk.to_csv(
+                    buf, columns=columns, header=False, index=False, na_rep='NaN',
+                    date_format='%Y-%m-%dT%H:%M:%S.%f%z',
+                )
+                buf.seek(0)
+                cursor.copy_expert(copy_sql, buf)
+            cursor.execute(
+                'INSERT INTO "%s" (%s) SELECT %s FROM "%s" ON CONFLICT (%s) DO UPDATE SET %s' % (
+                    table.name, col_str, col_str, staging_name,
+                    ', '.join('"%s"' % c for c in key_columns), update_str
+                )
+            )
+            raw_con.commit()
+        except Exception:
+            raw_con.rollback()
+            raise
+        finally:
+            raw_con.close()
+
+    def read(self, before=None, after=None, columns=None, locations=None, copy=True, resolution=None):
+        """Read rows as a DataFrame indexed by UTC time, newest first.
+
+        `columns` limits the value columns read and `locations` the
+        locations; both filters and the time range are done in SQL. By
+        default the result set is streamed with COPY and decoded with the
+        vectorized CSV parser instead of building Python objects per cell.
+
+        If `resolution` is given, bucket means at that resolution are
+        returned using read_aggregated().
+        """
+        if resolution is not None:
+            return self.read_aggregated(
+                resolution, agg='mean', before=before, after=after, columns=columns, locations=locations
+            )
+
         table = self.get_table()
-        query = table.select()
+        if columns is None:
+            columns = [x[0] for x in self.value_columns]
+        select_cols = []
+        if self.location_column:
+            select_cols.append(getattr(table.c, self.location_column))
+        select_cols += [getattr(table.c, c) for c in columns]
+
+        conditions = []
         if before:
-            query = query.where(table.c.time <= before)
+            conditions.append(table.c.time <= before)
         if after:
-            query = query.where(table.c.time >= after)
+            conditions.append(table.c.time >= after)
+        if locations:
+            conditions.append(getattr(table.c, self.location_column).in_(locations))
+
+        if not copy:
+            query = sa.select([table.c.time] + select_cols)
+            if conditions:
+                query = query.where(sa.and_(*conditions))
+            query = query.order_by(sa.desc(table.c.time))
+            with self.engine.connect() as con:
+                df = pd.read_sql(query, con, index_col='time')
+            df.index = pd.to_datetime(df.index, utc=True)
+            return df
+
+        # Transfer timestamps as integer microseconds so that they can be
+        # converted to datetimes without parsing strings.
+        epoch_us = sa.cast(sa.func.extract('epoch', table.c.time) * 1000000, sa.BigInteger).label('time')
+        query = sa.select([epoch_us] + select_cols)
+        if conditions:
+            query = query.where(sa.and_(*conditions))
         query = query.order_by(sa.desc(table.c.time))
+        return self._read_copy(query, [c.name for c in select_cols])
+
+    AGGREGATE_FUNCTIONS = {
+        'mean': sa.func.avg,
+        'sum': sa.func.sum,
+        'min': sa.func.min,
+        'max': sa.func.max,
+        'count': sa.func.count,
+    }
+
+    def _get_bucket_interval(self, bucket):
+        if isinstance(bucket, timedelta):
+            return sa.literal(bucket)
+        try:
+            return sa.literal(pd.to_timedelta(bucket).to_pytimedelta())
+        except ValueError:
+            # Calendar intervals like '1 month' are passed on to PostgreSQL
+            return sa.cast(sa.literal(bucket), sa.Interval)
+
+    @staticmethod
+    def _get_utc_offsets(timezone):
+        """Return the UTC offsets (in seconds) a timezone has used since 1970"""
+        tz = pytz.timezone(timezone)
+        offsets = {int(tz.utcoffset(datetime.now()).total_seconds())}
+        transitions = getattr(tz, '_utc_transition_times', [])
+        for transition_time, info in zip(transitions, getattr(tz, '_transition_info', [])):
+            if transition_time.year >= 1970:
+                offsets.add(int(info[0].total_seconds()))
+        return offsets
+
+    def _find_aggregate_view(self, bucket, before, after, timezone):
+        """Return the coarsest continuous aggregate that can answer a query.
+
+        The requested bucket has to consist of whole aggregate buckets, the
+        time range must start and end at aggregate bucket boundaries and
+        the aggregate must be materialized up to the end of the range. With
+        `timezone`, the aggregate buckets must also line up with the local
+        bucket boundaries. Returns (view name, view bucket, last view bucket
+        start) or None.
+        """
+        try:
+            requested = pd.to_timedelta(bucket).to_pytimedelta()
+        except ValueError:
+            # Calendar buckets are built from whole UTC days
+            if timezone:
+                return None
+            requested = timedelta(days=1)
+
+        epoch = pd.Timestamp(0, tz='UTC')
+        utc_offsets = self._get_utc_offsets(timezone) if timezone else set()
+
+        def is_aligned(ts, view_bucket):
+            ts = pd.Timestamp(ts)
+            if ts.tzinfo is None:
+                return False
+            return (ts.tz_convert('UTC') - epoch) % view_bucket == timedelta(0)
+
+        candidates = []
+        for view_name, view_bucket in reversed(self._get_continuous_aggregates()):
+            if requested % view_bucket:
+                continue
+            # UTC-aligned buckets cannot be regrouped into local buckets if
+            # they straddle local bucket boundaries (e.g. daily buckets)
+            if any(offset % view_bucket.total_seconds() for offset in utc_offsets):
+                continue
+            if after and not is_aligned(after, view_bucket):
+                continue
+            last_bucket = None
+            if before:
+                # Accept inclusive end times like 23:59:59 or 23:59:59.999999
+                for slack in (timedelta(0), timedelta(microseconds=1), timedelta(seconds=1)):
+                    if is_aligned(pd.Timestamp(before) + slack, view_bucket):
+                        last_bucket = pd.Timestamp(before) + slack - view_bucket
+                        break
+                else:
+                    continue
+            candidates.append((view_name, view_bucket, last_bucket))
+        if not candidates:
+            return None
+
         with self.engine.connect() as con:
-            df = pd.read_sql(query, con, index_col='time')
-        df.index = pd.to_datetime(df.index, utc=True)
+            data_start, data_end = con.execute(
+                'SELECT min(time), max(time) FROM "%s"' % self.measurement_name
+            ).fetchone()
+            if data_end is None:
+                return None
+            data_start = pd.Timestamp(data_start).tz_convert('UTC')
+            data_end = pd.Timestamp(data_end).tz_convert('UTC')
+            for view_name, view_bucket, last_bucket in candidates:
+                # Buckets outside the materialized range would be missing or stale
+                needed_start = epoch + ((data_start - epoch) // view_bucket) * view_bucket
+                if after:
+                    needed_start = max(needed_start, pd.Timestamp(after).tz_convert('UTC'))
+                needed_end = epoch + ((data_end - epoch) // view_bucket) * view_bucket
+                if last_bucket is not None:
+                    needed_end = min(needed_end, pd.Timestamp(last_bucket).tz_convert('UTC'))
+                if needed_end < needed_start:
+                    continue
+                materialized_start, materialized_end = self._get_materialized_range(con, view_name)
+                if materialized_end is None or pd.Timestamp(materialized_end) < needed_end:
+                    continue
+                if pd.Timestamp(materialized_start) > needed_start:
+                    continue
+                return view_name, view_bucket, last_bucket
+        return None
+
+    def read_aggregated(self, bucket, agg='mean', before=None, after=None, columns=None, locations=None,
+                        timezone=None):
+        """Read rows downsampled into time buckets by TimescaleDB.
+
+        `bucket` is a pandas-style offset ('1h', '15min'), a timedelta or a
+        PostgreSQL interval string ('1 month'). `agg` is one of 'mean',
+        'sum', 'min', 'max' and 'count', or a dict mapping value columns
+        to them. Rows are grouped by location as well if the target has a
+        location column. Only the aggregated rows are transferred. If
+        `timezone` is given, calendar buckets are aligned to it.
+
+        The query is answered from the coarsest continuous aggregate that
+        has the needed resolution, and from the raw table otherwise.
+        """
+        table = self.get_table()
+        if columns is None:
+            columns = [x[0] for x in self.value_columns]
+        if isinstance(agg, str):
+            agg = {c: agg for c in columns}
+        assert set(agg.keys()) == set(columns)
+
+        view = self._find_aggregate_view(bucket, before, after, timezone)
+        if view is not None:
+            view_name, view_bucket, last_bucket = view
+            view_cols = [sa.column('time')]
+            if self.location_column:
+                view_cols.append(sa.column(self.location_column))
+            for col_name in columns:
+                view_cols += [sa.column('%s_%s' % (col_name, func)) for func in ('sum', 'min', 'max', 'count')]
+            source = sa.table(view_name, *view_cols)
+
+            def aggregate(col_name, func):
+                c = source.c
+                if func == 'mean':
+                    col_sum = sa.func.sum(c['%s_sum' % col_name])
+                    col_count = sa.func.sum(c['%s_count' % col_name])
+                    return sa.cast(col_sum, sa.Float) / sa.func.nullif(col_count, 0)
+                elif func == 'count':
+                    return sa.cast(sa.func.sum(c['%s_count' % col_name]), sa.BigInteger)
+                return self.AGGREGATE_FUNCTIONS[func](c['%s_%s' % (col_name, func)])
+        else:
+            source = table
+            last_bucket = None
+
+            def aggregate(col_name, func):
+                return self.AGGREGATE_FUNCTIONS[func](source.c[col_name])
+
+        bucket_args = [self._get_bucket_interval(bucket), source.c.time]
+        if timezone:
+            bucket_args.append(sa.literal(timezone))
+        time_bucket = sa.func.time_bucket(*bucket_args)
+
+        select_cols = []
+        group_by = [time_bucket]
+        if self.location_column:
+            loc_col = source.c[self.location_column]
+            select_cols.append(loc_col)
+            group_by.append(loc_col)
+
+        dtypes = self._get_column_dtypes()
+        for col_name in columns:
+            select_cols.append(aggregate(col_name, agg[col_name]).label(col_name))
+            if agg[col_name] == 'count':
+                dtypes[col_name] = 'int64'
+            elif agg[col_name] == 'mean':
+                dtypes[col_name] = 'float64'
+
+        conditions = []
+        if before:
+            if last_bucket is not None:
+                conditions.append(source.c.time <= last_bucket.to_pydatetime())
+            else:
+                conditions.append(source.c.time <= before)
+        if after:
+            conditions.append(source.c.time >= after)
+        if locations:
+            conditions.append(source.c[self.location_column].in_(locations))
+
+        epoch_us = sa.cast(sa.func.extract('epoch', time_bucket) * 1000000, sa.BigInteger).label('time')
+        query = sa.select([epoch_us] + select_cols)
+        if conditions:
+            query = query.where(sa.and_(*conditions))
+        query = query.group_by(*group_by).order_by(sa.desc(time_bucket))
+        return self._read_copy(query, [c.name for c in select_cols], dtypes=dtypes)
+
+    def _get_column_dtypes(self):
+        dtypes = {name: {int: 'int64', float: 'float64', str: 'str'}[klass] for name, klass in self.value_columns}
+        if self.location_column:
+            dtypes[self.location_column] = {int: 'int64', float: 'float64', str: 'str'}[self.location_type]
+        dtypes['time'] = 'int64'
+        return dtypes
+
+    def _read_copy(self, query, columns, dtypes=None):
+        compiled = query.compile(dialect=self.engine.dialect)
+        buf = io.BytesIO()
+        raw_con = self.engine.raw_connection()
+        try:
+            cursor = raw_con.cursor()
+            sql = cursor.mogrify(str(compiled), compiled.params).decode('utf8')
+            cursor.copy_expert('COPY (%s) TO STDOUT WITH (FORMAT csv)' % sql, buf)
+        finally:
+            raw_con.close()
+        buf.seek(0)
+
+        names = ['time'] + columns
+        if dtypes is None:
+            dtypes = self._get_column_dtypes()
+        if buf.getbuffer().nbytes:
+            df = pd.read_csv(buf, header=None, names=names, dtype={c: dtypes[c] for c in names})
+        else:
+            df = pd.DataFrame({c: pd.Series(dtype=dtypes[c]) for c in names})
+        df['time'] = pd.to_datetime(df['time'], unit='us', utc=True)
+        return df.set_index('time')
+
+
+def find_complete_targets(targets):
+    """Check the completeness of many TimescaleDBTargets in one query.
+
+    Equivalent to `[t.exists() for t in targets]`, but the row counts of
+    all the (time window, locations) pairs, possibly spread over several
+    tables, are computed with a single grouped query.
+    """
+    if not targets:
+        return []
+
+    by_table = collections.OrderedDict()
+    for idx, target in enumerate(targets):
+        table = target.get_table()
+        by_table.setdefault((target.connection_dsn, table.name), []).append((idx, target))
+
+    counts = {}
+    for dsn in {key[0] for key in by_table.keys()}:
+        selects = []
+        params = {}
+        for group_nr, ((group_dsn, table_name), group) in enumerate(by_table.items()):
+            if group_dsn != dsn:
+                continue
+            # One row per (window, location) so that every window can have
+            # its own set of locations
+            idxs, starts, ends, locs = [], [], [], []
+            for idx, target in group:
+                for loc in (target.locations or [None]):
+                    idxs.append(idx)
+                    starts.append(target.start_time)
+                    ends.append(target.end_time)
+                    locs.append(str(loc) if loc is not None else None)
+
+            location_column = group[0][1].location_column
+            if location_column:
+                loc_cond = 'AND (w.loc IS NULL OR CAST(t."%s" AS text) = w.loc)' % location_column
+            else:
+                loc_cond = ''
+            selects.append(
+                'SELECT w.idx, count(t.time) AS row_count '
+                'FROM unnest(CAST(:idx_%(nr)d AS integer[]), CAST(:start_%(nr)d AS timestamptz[]), '
+                'CAST(:end_%(nr)d AS timestamptz[]), CAST(:loc_%(nr)d AS text[])) AS w(idx, ws, we, loc) '
+                'JOIN "%(table)s" t ON t.time >= w.ws AND t.time <= w.we %(loc_cond)s '
+                'GROUP BY w.idx' % dict(nr=group_nr, table=table_name, loc_cond=loc_cond)
+            )
+            params.update({
+                'idx_%d' % group_nr: idxs, 'start_%d' % group_nr: starts,
+                'end_%d' % group_nr: ends, 'loc_%d' % group_nr: locs,
+            })
+
+        engine = next(t for t in targets if t.connection_dsn == dsn).engine
+        with engine.connect() as con:
+            rows = con.execute(sa.text(' UNION ALL '.join(selects)), **params).fetchall()
+        for row in rows:
+            counts[row.idx] = counts.get(row.idx, 0) + row.row_count
 
-        return df
+    return [target._has_enough_rows(counts.get(idx, 0)) for idx, target in enumerate(targets)]
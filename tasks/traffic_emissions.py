@@ -0,0 +1,119 @@
+import logging
+from datetime import timedelta
+
+import luigi
+import numpy as np
+import pandas as pd
+
+from data_import import digitraffic, lipasto
+from utils.data_import import coalesce_intervals
+from utils.dvc import load_datasets
+import settings
+
+from .targets.timescaledb import TimescaleDBTarget
+from .digitraffic import DigitrafficTarget
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# LIPASTO vehicle types corresponding to the LAM vehicle classes. LAM
+# stations cannot tell delivery vans from cars.
+VEHICLE_CLASS_TO_LIPASTO = {
+    'ha/pa': 'Cars',
+    'kaip': 'Trucks:NoTrailer',
+    'bus': 'Buses',
+    'kapp': 'Trucks:Trailer',
+    'katp': 'Trucks:Trailer',
+    'ha+pk': 'Cars',
+    'ha+av': 'Cars',
+}
+
+# Before 2015 LIISA only reports trucks as one group
+LIPASTO_FALLBACK_TYPES = {
+    'Trucks:NoTrailer': 'Trucks',
+    'Trucks:Trailer': 'Trucks',
+}
+
+
+def get_emission_factors(unit_emissions, road_type):
+    """Return CO2e g/km for each LAM vehicle class, in VEHICLE_CLASSES order"""
+    factors = []
+    for vehicle_class in digitraffic.VEHICLE_CLASSES.values():
+        vehicle_type = VEHICLE_CLASS_TO_LIPASTO[vehicle_class]
+        if (vehicle_type, road_type) not in unit_emissions.index:
+            vehicle_type = LIPASTO_FALLBACK_TYPES[vehicle_type]
+        factors.append(unit_emissions.loc[(vehicle_type, road_type)])
+    return np.array(factors, dtype=float)
+
+
+class TrafficEmissionTarget(TimescaleDBTarget):
+    # CO2e emissions (kg) per km of road at each station direction
+    measurement_name = 'digitraffic_co2e_hourly'
+    value_columns = [('co2e', float)]
+    location_column = 'station_direction'
+    interval = 3600
+
+
+class DigitrafficEmissionsUpdate(luigi.Task):
+    """Compute hourly road traffic CO2e emissions from vehicle counts.
+
+    Hourly vehicle counts per class are summed in TimescaleDB and multiplied
+    by LIPASTO (LIISA) unit emissions of the matching vehicle types, giving
+    the emissions per km of road around each LAM station direction. Only
+    the hours touched by vehicle count writes not processed yet are
+    recomputed, unless `full` is set or no emissions have been computed.
+    """
+    municipality = luigi.Parameter(default='Helsinki')
+    road_type = luigi.ChoiceParameter(choices=['Urban', 'Highways'], default='Highways')
+    full = luigi.BoolParameter(description='Recompute the whole history')
+
+    # Longest range of hourly counts read at once
+    max_read_range = timedelta(days=31)
+
+    def output(self):
+        now = pd.Timestamp.now(tz=digitraffic.LOCAL_TZ)
+        return TrafficEmissionTarget(settings.POSTGRESQL_DSN, start_time=now, end_time=now)
+
+    def complete(self):
+        return False
+
+    def get_hour_ranges(self, intervals):
+        """Return the (first hour, last hour) ranges covering `intervals`, at most `max_read_range` long"""
+        hour = timedelta(hours=1)
+        intervals = [(start.floor('h'), end.floor('h')) for start, end in intervals]
+        return coalesce_intervals(intervals, hour, max_distance=hour, max_length=self.max_read_range)
+
+    def run(self):
+        liisa_df = load_datasets('vtt/lipasto/emissions_by_municipality')
+        unit_emissions = lipasto.calculate_unit_emissions(liisa_df, self.municipality)
+        factors = get_emission_factors(unit_emissions, self.road_type)
+
+        target = self.output()
+        counts_target = DigitrafficTarget(settings.POSTGRESQL_DSN, start_time=target.start_time, end_time=target.end_time)
+
+        # Taken before reading the counts, so writes committed during this
+        # run stay unprocessed and are handled on the next one
+        writes = counts_target.get_unprocessed_writes()
+        if self.full or target.get_latest_row() is None:
+            first, last = counts_target.get_time_range()
+            ranges = self.get_hour_ranges([(first, last)]) if first is not None else []
+        else:
+            ranges = self.get_hour_ranges([(start, end) for _, start, end in writes])
+
+        class_columns = list(digitraffic.VEHICLE_CLASSES.values())
+        rows = 0
+        for first_hour, last_hour in ranges:
+            before = last_hour + timedelta(hours=1) - timedelta(microseconds=1)
+            counts = counts_target.read_aggregated('1h', agg='sum', after=first_hour, before=before)
+            if not len(counts):
+                continue
+            # g/km per vehicle * vehicles -> kg per km of road
+            co2e = counts[class_columns].to_numpy(dtype=float) @ factors / 1000
+            df = pd.DataFrame({'station_direction': counts['station_direction'].to_numpy(), 'co2e': co2e}, index=counts.index)
+            target.write(df)
+            rows += len(df)
+
+        counts_target.mark_writes_processed([write_id for write_id, _, _ in writes])
+        logger.info('Updated %d station-direction hours in %d ranges' % (rows, len(ranges)))
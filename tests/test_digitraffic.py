@@ -0,0 +1,71 @@
+import functools
+from datetime import date
+
+import luigi
+import pandas as pd
+
+import settings
+from data_import import digitraffic
+from tasks import digitraffic as digitraffic_tasks
+
+
+STATION = {
+    'id': 101,
+    'name': 'test_station',
+    'direction1_municipality': 'Keskusta',
+    'direction2_municipality': 'Espoo',
+}
+
+
+def make_raw_content(measurement_date, passages):
+    day_of_year = measurement_date.timetuple().tm_yday
+    lines = []
+    for hour, minute, direction, vehicle_class in passages:
+        row = dict(
+            station_id=STATION['id'], year=measurement_date.year % 100, day_of_year=day_of_year,
+            hour=hour, minute=minute, second=12, second_10ms=34, length=4.5, lane=direction,
+            direction=direction, vehicle_class=vehicle_class, speed=50,
+        )
+        lines.append(';'.join(str(row.get(field, 0)) for field in digitraffic.RAW_DATA_FIELDS))
+    return '\n'.join(lines) + '\n'
+
+
+def test_raw_parquet_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'DATA_DIR', str(tmp_path))
+    # DST starts on this day, so it only has 23 hours
+    measurement_date = date(2024, 3, 31)
+    passages = [(0, 5, 1, 1), (0, 5, 1, 2), (2, 30, 2, 3), (4, 0, 1, 1), (23, 59, 2, 1)]
+    content = make_raw_content(measurement_date, passages)
+    df = digitraffic.parse_tms_station_raw_data(STATION['id'], measurement_date, content)
+
+    path = digitraffic_tasks.get_raw_data_path(STATION['name'], measurement_date, 'parquet')
+    digitraffic_tasks.write_raw_parquet(luigi.LocalTarget(path), df)
+    read_df = digitraffic_tasks.read_raw_parquet(STATION['name'], measurement_date)
+    pd.testing.assert_frame_equal(read_df, df)
+
+    names = digitraffic_tasks.get_station_location_names(STATION)
+    counts = digitraffic.count_vehicles_per_minute(read_df, measurement_date, names)
+    expected = digitraffic.count_vehicles_per_minute(df, measurement_date, names)
+    pd.testing.assert_frame_equal(counts, expected)
+    class_names = list(digitraffic.VEHICLE_CLASSES.values())
+    assert counts[class_names].to_numpy().sum() == len(passages)
+    first = counts[counts['station_direction'] == names[0]].iloc[0]
+    assert first.name == pd.Timestamp('2024-03-31 00:05', tz='Europe/Helsinki')
+    assert first['ha/pa'] == 1 and first['kaip'] == 1
+
+
+def test_daily_bulk_complete_accepts_iterator(monkeypatch):
+    dates = [date(2024, 1, 1), date(2024, 1, 2), date(2024, 1, 3)]
+    complete_dates = {dates[0], dates[2]}
+
+    def find_complete_targets(targets):
+        return [t.start_time.astimezone(digitraffic.LOCAL_TZ).date() in complete_dates for t in targets]
+
+    monkeypatch.setattr(digitraffic_tasks, 'get_station_by_name', lambda name: STATION)
+    monkeypatch.setattr(digitraffic_tasks, 'find_complete_targets', find_complete_targets)
+
+    # This is how luigi's RangeDaily calls it
+    cls = digitraffic_tasks.DigitrafficVehicleCountDaily
+    cls_with_params = functools.partial(cls, station_name=STATION['name'])
+    completed = cls.bulk_complete.__func__(cls_with_params, iter(dates))
+    assert completed == [dates[0], dates[2]]
@@ -0,0 +1,49 @@
+import os
+import threading
+
+
+class Checkpoint:
+    """Append-only on-disk record of completed work items.
+
+    Each completed key is written as its own line and flushed immediately,
+    so a crashed run can be resumed by skipping the keys found in the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.done = {line.strip() for line in f if line.strip()}
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def keys(self):
+        # Return a copy so callers can iterate while other threads mark keys done
+        with self.lock:
+            return list(self.done)
+
+    def mark_done(self, key):
+        assert '\n' not in key
+        with self.lock:
+            if key in self.done:
+                return
+            dir_name = os.path.dirname(self.path)
+            if dir_name:
+                os.makedirs(dir_name, exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(key + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.done.add(key)
+
+    def clear(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.done = set()
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, date
 
 
@@ -41,3 +42,81 @@ def find_data_start(check_func, max_date=None, min_date=None):
             td /= 2
 
     return last_good
+
+
+def find_data_start_parallel(check_func, max_date=None, min_date=None, probes=4, memo=None, executor=None):
+    """Find the first date with valid data with a k-ary search.
+
+    Like `find_data_start`, `max_date` is assumed to have valid data and
+    data is assumed to be valid on every date after the first valid one.
+    Each round checks `probes` dates spread evenly over the remaining
+    range concurrently, so the range shrinks `probes + 1`-fold per round
+    instead of twofold. Results are stored in `memo` (a dict of date ->
+    bool) if one is given, and already known dates are not checked again.
+    The search covers everything back to `MIN_DATE` unless `min_date` is
+    given. Returns `min_date` if it already has valid data.
+    """
+    if not max_date:
+        max_date = date.today()
+    if not min_date:
+        min_date = MIN_DATE
+    if memo is None:
+        memo = {}
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=probes)
+
+    # Data is known to be invalid on `last_bad` and valid on `first_good`
+    last_bad = min_date - timedelta(days=1)
+    first_good = max_date
+    try:
+        while (first_good - last_bad).days > 1:
+            span = (first_good - last_bad).days
+            dates = sorted({
+                last_bad + timedelta(days=max(1, min(span - 1, round(span * i / (probes + 1)))))
+                for i in range(1, probes + 1)
+            })
+            unknown = [d for d in dates if d not in memo]
+            for d, is_ok in zip(unknown, executor.map(check_func, unknown)):
+                memo[d] = bool(is_ok)
+            for d in dates:
+                if memo[d]:
+                    first_good = d
+                    break
+                last_bad = d
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    return first_good
+
+
+def coalesce_intervals(intervals, step, max_distance, max_length=None):
+    """Merge sorted (start, end) intervals into a minimal set of requests.
+
+    Intervals closer than `max_distance` to each other are fetched in
+    the same request, as long as the merged interval stays shorter than
+    `max_length`. Long intervals are split into `max_length` pieces.
+    `step` is the sample interval of the series.
+    """
+    out = []
+    for start, end in sorted(intervals):
+        if out:
+            last_start, last_end = out[-1]
+            merged_too_long = max_length is not None and end - last_start > max_length
+            if start - last_end <= max_distance and not merged_too_long:
+                out[-1] = (last_start, max(last_end, end))
+                continue
+        out.append((start, end))
+
+    if max_length is None:
+        return out
+
+    split = []
+    for start, end in out:
+        while end - start > max_length:
+            split.append((start, start + max_length - step))
+            start += max_length
+        split.append((start, end))
+    return split
@@ -0,0 +1,16 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def get_http_session(pool_size=16, retries=5, backoff_factor=1.0):
+    """Return a requests session with a connection pool and retry/backoff"""
+    session = requests.Session()
+    retry = Retry(
+        total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=('GET', 'HEAD'),
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
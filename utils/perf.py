@@ -35,3 +35,39 @@ class PerfCounter:
             diff_str = ''
         print('%s%s%4.1f ms%s: %s' % ((pc_data.depth - 1) * '  ', tag_str, cur_ms, diff_str, name))
         self.last_display = now
+
+
+class ThroughputMeter:
+    """Thread-safe counter for reporting progress and rows/s of long jobs"""
+
+    def __init__(self, total=None, tag=None):
+        self.start = time.perf_counter()
+        self.total = total
+        self.tag = tag
+        self.done = 0
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def update(self, rows, done=1):
+        with self.lock:
+            self.done += done
+            self.rows += rows
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def format(self):
+        tag_str = '[%s] ' % self.tag if self.tag else ''
+        if self.total:
+            progress = '%d/%d (%.1f %%)' % (self.done, self.total, 100 * self.done / self.total)
+        else:
+            progress = '%d' % self.done
+        return '%s%s done, %d rows in %.1f s (%.0f rows/s)' % (
+            tag_str, progress, self.rows, self.elapsed, self.rows_per_second
+        )
@@ -0,0 +1,38 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter.
+
+    Tokens are replenished continuously at `rate` tokens per second up to
+    `capacity`. `acquire()` blocks until a token is available, so the bucket
+    can be shared by all the workers of a pool to stay within an API quota.
+    """
+
+    def __init__(self, rate, capacity=None):
+        assert rate > 0
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, requests_per_minute, capacity=None):
+        return cls(requests_per_minute / 60, capacity=capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self, tokens=1):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)